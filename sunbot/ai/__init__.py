@@ -0,0 +1 @@
+""" Helpers for Sunbot's OpenAI features. """
@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from sunbot.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """ Content-addressed cache for OpenAI responses, with an in-memory LRU tier in front of an on-disk tier
+
+        Each entry is stored as <key>.json, generated images are stored beside it as <key>-<n>.png so they
+        can be uploaded straight from disk. The disk tier is trimmed oldest first when it grows past max_bytes.
+
+        Attributes:
+            directory (Path): Where cached responses are stored
+            ttl (int): Time in seconds a response is reused for
+            max_bytes (int): The maximum size of the on-disk tier
+            memory (TTLCache): The in-memory tier
+    """
+
+    def __init__(self, directory: str, ttl: int, max_bytes: int, memory_size: int) -> None:
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory: TTLCache[str, Dict[str, Any]] = TTLCache(maxsize=memory_size, ttl=ttl)
+
+        self.disk_hits = 0
+        self._size: Optional[int] = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def key(kind: str, prompt: str, **params: Any) -> str:
+        """ Builds the cache key for a prompt, ignoring case and whitespace differences """
+        normalized = " ".join(prompt.casefold().split())
+        payload = json.dumps({"kind": kind, "prompt": normalized, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def _read_entry(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._entry_path(key)
+        try:
+            entry = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+
+        if entry["created"] + self.ttl < time.time():
+            return None
+
+        entry["images"] = [str(self.directory / name) for name in entry.get("images", [])]
+        if not all(Path(image).exists() for image in entry["images"]):
+            return None
+        return entry
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """ Gets a cached entry, with either a "text" response or a list of "images" file paths """
+        entry = self.memory.get(key)
+        if entry is not None:
+            return entry
+
+        entry = await asyncio.to_thread(self._read_entry, key)
+        if entry is not None:
+            self.disk_hits += 1
+            # Only kept in memory for what is left of its TTL, not a fresh one
+            self.memory.set(key, entry, ttl=entry["created"] + self.ttl - time.time())
+        return entry
+
+    async def get_text(self, key: str) -> Optional[str]:
+        entry = await self.get(key)
+        return entry.get("text") if entry else None
+
+    async def get_images(self, key: str) -> Optional[List[str]]:
+        entry = await self.get(key)
+        return entry.get("images") if entry else None
+
+    def _write_entry(self, key: str, text: Optional[str], images: List[bytes]) -> Dict[str, Any]:
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        names = []
+        written = 0
+        for index, data in enumerate(images):
+            name = f"{key}-{index}.png"
+            (self.directory / name).write_bytes(data)
+            names.append(name)
+            written += len(data)
+
+        created = time.time()
+        payload = json.dumps({"created": created, "text": text, "images": names})
+        self._entry_path(key).write_text(payload)
+        written += len(payload)
+
+        if self._size is None:
+            self._size = sum(path.stat().st_size for path in self.directory.iterdir())
+        else:
+            self._size += written
+
+        if self._size > self.max_bytes:
+            self._trim()
+
+        return {"created": created, "text": text, "images": [str(self.directory / name) for name in names]}
+
+    def _trim(self) -> None:
+        """ Removes the oldest entries until the disk tier is back under 90% of max_bytes """
+        files = sorted(self.directory.iterdir(), key=lambda path: path.stat().st_mtime)
+        for path in files:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except OSError:
+                continue
+            self._size -= size
+            self.memory.invalidate(path.stem.split("-")[0])
+
+        logger.info('Trimmed OpenAI response cache to %d bytes', self._size)
+
+    async def _set(self, key: str, text: Optional[str], images: List[bytes]) -> Optional[Dict[str, Any]]:
+        try:
+            async with self._lock:
+                entry = await asyncio.to_thread(self._write_entry, key, text, images)
+        except OSError:
+            logger.exception('Failed to write OpenAI response to the cache')
+            return None
+
+        self.memory.set(key, entry)
+        return entry
+
+    async def set_text(self, key: str, text: str) -> None:
+        await self._set(key, text, [])
+
+    async def set_images(self, key: str, images: List[bytes]) -> Optional[List[str]]:
+        """ Stores generated images, returning the paths they were written to or None if they couldn't be written """
+        entry = await self._set(key, None, images)
+        return entry["images"] if entry else None
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import math
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import tiktoken
+
+from sunbot.ai.history import HistoryMessage
+from sunbot.ai.images import AttachmentImages, ProcessedImage
+
+logger = logging.getLogger(__name__)
+
+# Fixed overhead the chat format adds for every message
+MESSAGE_TOKEN_OVERHEAD = 4
+# Cost of an image we don't know the size of, what a 1024x1024 image costs a vision model
+IMAGE_TOKEN_COST = 765
+# Vision models charge a base cost plus a cost for each 512px tile, after fitting the image in 2048px then 768px on its short side
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+# Time in seconds before loading a tokenizer that failed is tried again
+TOKENIZER_RETRY_INTERVAL = 300
+
+_encodings: Dict[str, tiktoken.Encoding] = {}
+_encoding_failures: Dict[str, float] = {}
+
+
+def get_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    """ Gets the tokenizer for a model, falling back to the encoding used by current chat models """
+    if (encoding := _encodings.get(model)) is not None:
+        return encoding
+
+    # Only failures are retried, and not on every message as loading blocks while it downloads
+    failed = _encoding_failures.get(model)
+    if failed is not None and time.monotonic() - failed < TOKENIZER_RETRY_INTERVAL:
+        return None
+
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+    except OSError:
+        # The encoding data is downloaded the first time it is used
+        _encoding_failures[model] = time.monotonic()
+        logger.exception('Failed to load tokenizer for %s, token counts will be estimated', model)
+        return None
+
+    _encoding_failures.pop(model, None)
+    _encodings[model] = encoding
+    return encoding
+
+
+def count_tokens(text: str, model: str) -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1 + MESSAGE_TOKEN_OVERHEAD
+    return len(encoding.encode(text, disallowed_special=())) + MESSAGE_TOKEN_OVERHEAD
+
+
+def message_tokens(msg: HistoryMessage, model: str) -> int:
+    """ Gets the number of tokens for a message's text, this is memoized on the message until it is re-rendered """
+    if msg.tokens is None:
+        content = msg.chat["content"]
+        if not isinstance(content, str):
+            content = "".join(part["text"] for part in content if part["type"] == "text")
+        msg.tokens = count_tokens(content, model)
+    return msg.tokens
+
+
+def image_tokens(image: ProcessedImage) -> int:
+    """ Gets the number of tokens a vision model charges for an image, at the size it is sent """
+    if image.width is None or image.height is None:
+        return IMAGE_TOKEN_COST
+
+    width, height = float(image.width), float(image.height)
+    if max(width, height) > 2048:
+        scale = 2048 / max(width, height)
+        width, height = width * scale, height * scale
+    if min(width, height) > 768:
+        scale = 768 / min(width, height)
+        width, height = width * scale, height * scale
+    tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+
+async def build_context(
+    msgs: Sequence[HistoryMessage],
+    system_context: Sequence[str],
+    model: str,
+    token_budget: int,
+    max_images: int,
+    images: Optional[AttachmentImages] = None,
+) -> List[Dict]:
+    """ Builds the chat messages to send, keeping the newest messages that fit in the token budget
+
+        Args:
+            msgs (Sequence[HistoryMessage]): The messages to choose from, oldest first
+            system_context (Sequence[str]): System messages that are always included
+            model (str): The model the messages are for, used to pick the tokenizer
+            token_budget (int): The maximum number of prompt tokens to use
+            max_images (int): The maximum number of images to include, newest first
+            images (AttachmentImages): Used to send downscaled copies of images, otherwise their URLs are sent
+    """
+    system_messages = [{"role": "system", "content": text} for text in system_context]
+    remaining = token_budget - sum(count_tokens(text, model) for text in system_context)
+
+    # Images are only sent when the content is a list of parts, only the newest max_images attachments are considered
+    candidates: List[Tuple[HistoryMessage, List[Tuple[int, str]]]] = []
+    attachment_count = 0
+    for msg in reversed(msgs):
+        attachments = []
+        if msg.chat is not None and not isinstance(msg.chat["content"], str):
+            attachments = list(msg.images.items())[:max(0, max_images - attachment_count)]
+            attachment_count += len(attachments)
+        candidates.append((msg, attachments))
+
+    # Process every image up front and at once, so each is charged for the size it is sent at
+    if images is not None:
+        processed = await asyncio.gather(*[
+            images.get(attachment_id, url) for _, attachments in candidates for attachment_id, url in attachments
+        ])
+    else:
+        # Without processing the model fetches the URLs itself, they are also what we de-duplicate on
+        processed = [ProcessedImage(url, url) for _, attachments in candidates for _, url in attachments]
+
+    # The same image is often posted more than once, only the newest copy is sent and charged for
+    seen = set()
+    chat_messages: List[Dict] = []
+    position = 0
+    for msg, attachments in candidates:
+        message_images = processed[position:position + len(attachments)]
+        position += len(attachments)
+        if msg.chat is None:
+            continue
+
+        cost = message_tokens(msg, model)
+        parts = []
+        digests = set()
+        for image in message_images:
+            if image is not None and image.digest not in seen and image.digest not in digests:
+                digests.add(image.digest)
+                parts.append({"type": "image_url", "image_url": {"url": image.data_url}})
+                cost += image_tokens(image)
+
+        # Always include the newest message, even if it is over the budget on its own
+        if cost > remaining and chat_messages:
+            break
+
+        seen.update(digests)
+        chat_messages.append({**msg.chat, "content": msg.chat["content"] + parts} if parts else msg.chat)
+        remaining -= cost
+
+    chat_messages.reverse()
+    return system_messages + chat_messages
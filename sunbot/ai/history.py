@@ -0,0 +1,227 @@
+import logging
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Deque, Dict, List, Optional
+
+import hikari
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class HistoryMessage:
+    """ A message kept in the history buffer, along with its rendered chat message
+        Attributes:
+            id (int): The ID of the message
+            channel_id (int): The channel the message was sent in
+            author_id (int): The ID of the author
+            author_name (str): The username of the author
+            created_at (datetime): When the message was sent
+            content (str): The text content of the message
+            mentions (Dict[int, str]): Map of mentioned user IDs to their username
+            images (Dict[int, str]): Map of image attachment IDs to their URL
+            chat (Dict): The message rendered for the chat API, None if there is nothing to send
+            tokens (int): The number of tokens in the rendered text, counted when first needed
+    """
+
+    id: int
+    channel_id: int
+    author_id: int
+    author_name: str
+    created_at: datetime
+    content: Optional[str]
+    mentions: Dict[int, str] = field(default_factory=dict)
+    images: Dict[int, str] = field(default_factory=dict)
+    chat: Optional[Dict] = None
+    tokens: Optional[int] = None
+
+    @classmethod
+    def from_message(cls, message: hikari.Message) -> 'HistoryMessage':
+        return cls(
+            id=message.id,
+            channel_id=message.channel_id,
+            author_id=message.author.id,
+            author_name=message.author.username,
+            created_at=message.created_at,
+            content=message.content,
+            mentions={user.id: user.username for user in message.user_mentions.values()} if message.user_mentions else {},
+            images={
+                attach.id: attach.url for attach in message.attachments
+                if attach.media_type and attach.media_type.lower().startswith('image')
+            },
+        )
+
+    def render(self, me_id: int, use_vision: bool) -> None:
+        """ Renders the message into the format used by the chat API """
+        self.tokens = None
+        if self.content is None:
+            self.chat = None
+            return
+
+        role = 'assistant' if self.author_id == me_id else 'user'
+        content = self.content
+
+        # Replace any user mentions with thier username
+        for user_id, username in self.mentions.items():
+            content = content.replace(f'<@{user_id}>', f'@{username}')
+
+        if role == 'user':
+            content = f'{self.author_name}({self.author_id}): {content}'
+
+        # If we are using a vision model the content is a list of parts, images are added when building the context
+        if use_vision:
+            content = [{"type": "text", "text": content}]
+
+        self.chat = {
+            "role": role,
+            "content": content
+        }
+
+
+class ChannelHistory:
+    """ The buffered messages for a single channel
+        Attributes:
+            messages (Deque[HistoryMessage]): The most recent messages, oldest first
+            complete_since (datetime): We have seen every message in the channel after this time
+    """
+    __slots__ = ("messages", "complete_since")
+
+    def __init__(self, size: int, complete_since: datetime) -> None:
+        self.messages: Deque[HistoryMessage] = deque(maxlen=size)
+        self.complete_since = complete_since
+
+    def find(self, message_id: int) -> Optional[HistoryMessage]:
+        # Lookups are almost always for recent messages, so search from the newest
+        for message in reversed(self.messages):
+            if message.id == message_id:
+                return message
+            if message.id < message_id:
+                return None
+        return None
+
+
+class MessageHistory:
+    """ Bounded per-channel ring buffers of recent messages, used to build AI context without REST calls
+
+        Channels are evicted least recently used first once the total number of buffered messages
+        goes over max_messages. A channel we have no complete history for is backfilled from REST.
+
+        Attributes:
+            rest (hikari.api.RESTClient): Used to backfill channels we don't have history for
+            me_id (int): The ID of the bot user, used when rendering messages
+            use_vision (bool): Whether to render image attachments
+            channel_size (int): The maximum number of messages to keep per channel
+            max_messages (int): The maximum number of messages to keep across all channels
+    """
+
+    def __init__(self, rest: hikari.api.RESTClient, me_id: int, use_vision: bool, channel_size: int, max_messages: int) -> None:
+        self.rest = rest
+        self.me_id = me_id
+        self.use_vision = use_vision
+        self.channel_size = channel_size
+        self.max_messages = max_messages
+
+        self.backfills = 0
+        self._channels: OrderedDict[int, ChannelHistory] = OrderedDict()
+        self._total = 0
+
+    def __len__(self) -> int:
+        return self._total
+
+    def _append(self, channel: ChannelHistory, message: HistoryMessage) -> None:
+        if len(channel.messages) == channel.messages.maxlen:
+            channel.messages.popleft()
+            channel.complete_since = channel.messages[0].created_at
+            self._total -= 1
+
+        channel.messages.append(message)
+        self._total += 1
+
+    def _evict(self) -> None:
+        # The most recently used channel is never evicted, even if it alone is over the limit
+        while self._total > self.max_messages and len(self._channels) > 1:
+            channel_id, channel = self._channels.popitem(last=False)
+            self._total -= len(channel.messages)
+            logger.debug('Evicted message history for channel %d', channel_id)
+
+    def add(self, message: hikari.Message) -> None:
+        """ Adds a newly created message to its channel's buffer """
+        channel = self._channels.get(message.channel_id)
+        if channel is None:
+            # We've seen everything in this channel from now on
+            channel = self._channels[message.channel_id] = ChannelHistory(self.channel_size, message.created_at)
+        elif channel.messages and channel.messages[-1].id >= message.id:
+            # Out of order or already added, this can happen with a backfill racing the gateway
+            return
+
+        entry = HistoryMessage.from_message(message)
+        entry.render(self.me_id, self.use_vision)
+
+        self._append(channel, entry)
+        self._channels.move_to_end(message.channel_id)
+        self._evict()
+
+    def update(self, message: hikari.PartialMessage) -> None:
+        """ Updates a buffered message after it has been edited """
+        channel = self._channels.get(message.channel_id)
+        entry = channel.find(message.id) if channel else None
+        if entry is None:
+            return
+
+        if message.content is not hikari.UNDEFINED:
+            entry.content = message.content
+        if message.user_mentions is not hikari.UNDEFINED:
+            entry.mentions = {user.id: user.username for user in message.user_mentions.values()}
+
+        entry.render(self.me_id, self.use_vision)
+
+    def delete(self, channel_id: int, *message_ids: int) -> None:
+        """ Removes deleted messages from a channel's buffer """
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            return
+
+        remaining = [message for message in channel.messages if message.id not in message_ids]
+        self._total -= len(channel.messages) - len(remaining)
+        channel.messages.clear()
+        channel.messages.extend(remaining)
+
+    async def get(self, channel_id: int, after: datetime, limit: Optional[int] = None) -> List[HistoryMessage]:
+        """ Gets the messages in a channel sent after the given time, oldest first, limited to the newest ones """
+        channel = self._channels.get(channel_id)
+
+        if channel is None or channel.complete_since > after:
+            channel = await self._backfill(channel_id, after)
+
+        self._channels.move_to_end(channel_id)
+        messages = [message for message in channel.messages if message.created_at > after]
+        if limit is not None:
+            messages = messages[-limit:]
+        return messages
+
+    async def _backfill(self, channel_id: int, after: datetime) -> ChannelHistory:
+        self.backfills += 1
+        logger.debug('Backfilling message history for channel %d', channel_id)
+
+        fetched = await self.rest.fetch_messages(channel_id, after=after)
+
+        # Merge with anything we have buffered, as messages may have arrived during the fetch
+        messages: Dict[int, HistoryMessage] = {}
+        for message in fetched:
+            entry = HistoryMessage.from_message(message)
+            entry.render(self.me_id, self.use_vision)
+            messages[entry.id] = entry
+
+        old_channel = self._channels.pop(channel_id, None)
+        if old_channel is not None:
+            self._total -= len(old_channel.messages)
+            for entry in old_channel.messages:
+                messages.setdefault(entry.id, entry)
+
+        channel = self._channels[channel_id] = ChannelHistory(self.channel_size, after)
+        for message_id in sorted(messages):
+            self._append(channel, messages[message_id])
+
+        self._evict()
+        return channel
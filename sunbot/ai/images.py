@@ -0,0 +1,134 @@
+import asyncio
+import base64
+import hashlib
+import io
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+from PIL import Image
+
+from sunbot.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Attachments never change, entries only expire so the cache doesn't hold images from long dead conversations
+IMAGE_CACHE_TTL = 86400
+# Downloads that failed are retried after this many seconds, images that can't be decoded are only retried once they expire
+FAILED_DOWNLOAD_TTL = 60
+# Attachments larger than this aren't downloaded, it is also the most a vision model accepts
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+JPEG_QUALITY = 85
+
+
+@dataclass(frozen=True)
+class ProcessedImage:
+    """ An image attachment that has been downscaled for sending to a vision model
+        Attributes:
+            digest (str): sha256 of the original attachment, identical images share a digest
+            data_url (str): The downscaled image encoded as a JPEG data URL
+            width (int): The width of the downscaled image, None if it wasn't processed
+            height (int): The height of the downscaled image, None if it wasn't processed
+    """
+    digest: str
+    data_url: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+
+def downscale(data: bytes, max_edge: int) -> Tuple[str, int, int]:
+    """ Shrinks an image so neither side is over max_edge and returns it as a JPEG data URL, with its new size """
+    with Image.open(io.BytesIO(data)) as image:
+        # thumbnail keeps the aspect ratio and never enlarges, for JPEGs it also decodes at a reduced size
+        image.thumbnail((max_edge, max_edge))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        width, height = image.size
+
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("ascii"), width, height
+
+
+class AttachmentImages:
+    """ Fetches image attachments once and keeps a downscaled copy to send to vision models
+
+        Without this the model fetches every attachment from the CDN itself, at full resolution,
+        each time a message with an image is part of the context.
+
+        Attributes:
+            session (aiohttp.ClientSession): The session attachments are downloaded with
+            max_edge (int): The maximum width or height of a processed image
+            fetches (int): The number of attachments downloaded
+            failures (int): The number of attachments that couldn't be downloaded or decoded
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, max_edge: int, cache_size: int) -> None:
+        self.session = session
+        self.max_edge = max_edge
+        self.fetches = 0
+        self.failures = 0
+
+        # Failed attachments are cached as None so they aren't retried on every reply, download failures only briefly
+        self._by_attachment: TTLCache[int, Optional[ProcessedImage]] = TTLCache(cache_size, IMAGE_CACHE_TTL)
+        self._by_digest: TTLCache[str, ProcessedImage] = TTLCache(cache_size, IMAGE_CACHE_TTL)
+        self._pending: Dict[int, asyncio.Future] = {}
+
+    async def get(self, attachment_id: int, url: str) -> Optional[ProcessedImage]:
+        """ Gets the processed image for an attachment, returns None if it couldn't be processed """
+        image = self._by_attachment.get(attachment_id, False)
+        if image is not False:
+            return image
+
+        # Several replies can be built from the same messages at once, only fetch each attachment once
+        pending = self._pending.get(attachment_id)
+        if pending is None:
+            pending = self._pending[attachment_id] = asyncio.ensure_future(self._load(attachment_id, url))
+            pending.add_done_callback(lambda _: self._pending.pop(attachment_id, None))
+        return await asyncio.shield(pending)
+
+    async def _download(self, url: str) -> bytes:
+        async with self.session.get(url) as response:
+            response.raise_for_status()
+            if response.content_length is not None and response.content_length > MAX_IMAGE_BYTES:
+                raise ValueError(f"attachment is {response.content_length} bytes")
+
+            # The length isn't always sent, so the limit is also checked as the body arrives
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data += chunk
+                if len(data) > MAX_IMAGE_BYTES:
+                    raise ValueError(f"attachment is over {MAX_IMAGE_BYTES} bytes")
+            return bytes(data)
+
+    async def _load(self, attachment_id: int, url: str) -> Optional[ProcessedImage]:
+        self.fetches += 1
+        try:
+            data = await self._download(url)
+            digest = hashlib.sha256(data).hexdigest()
+            image = self._by_digest.get(digest)
+            if image is None:
+                image = ProcessedImage(digest, *await asyncio.to_thread(downscale, data, self.max_edge))
+                self._by_digest.set(digest, image)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning('Failed to download image attachment %d: %s', attachment_id, e)
+            self.failures += 1
+            self._by_attachment.set(attachment_id, None, ttl=FAILED_DOWNLOAD_TTL)
+            return None
+        except (ValueError, OSError, Image.DecompressionBombError) as e:
+            logger.warning('Failed to process image attachment %d: %s', attachment_id, e)
+            self.failures += 1
+            image = None
+
+        self._by_attachment.set(attachment_id, image)
+        return image
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "fetches": self.fetches,
+            "failures": self.failures,
+            "cached": len(self._by_attachment),
+            "hit_rate": self._by_attachment.hit_rate,
+        }
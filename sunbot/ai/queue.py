@@ -0,0 +1,197 @@
+import asyncio
+import bisect
+import enum
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class Priority(enum.IntEnum):
+    """ Priority of an AI request, lower values are started first """
+    COMMAND = 0
+    REPLY = 1
+    RANDOM = 2
+
+
+class QueueFull(Exception):
+    """ Raised when a request is rejected, or dropped for a more important one, because the queue is full """
+
+
+@dataclass(order=True)
+class _Job:
+    priority: Priority
+    seq: int
+    guild_id: int = field(compare=False)
+    enqueued: float = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class AIRequestQueue:
+    """ Limits how many OpenAI requests run at once, globally and per guild
+
+        Waiting requests are started in priority order. When OpenAI responds with a 429 the queue pauses
+        for the Retry-After time (or an exponential backoff), halves its concurrency and retries the request,
+        then grows the concurrency back one request at a time as requests succeed.
+
+        Attributes:
+            max_concurrent (int): The maximum number of requests running at once
+            max_per_guild (int): The maximum number of requests running at once for a single guild
+            max_queued (int): The maximum number of requests waiting to start
+            max_retries (int): How many times a rate limited request is retried
+    """
+
+    def __init__(self, max_concurrent: int, max_per_guild: int, max_queued: int, max_retries: int = 3) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_per_guild = max_per_guild
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+
+        self._limit = max_concurrent
+        self._pending: List[_Job] = []
+        self._active = 0
+        self._active_guilds: Dict[int, int] = {}
+        self._seq = 0
+        self._paused_until = 0.0
+        self._resume: Optional[asyncio.TimerHandle] = None
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.rate_limited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def stats(self) -> Dict[str, float]:
+        started = self.submitted - self.rejected - self.depth
+        return {
+            "depth": self.depth,
+            "active": self._active,
+            "limit": self._limit,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "rate_limited": self.rate_limited,
+            "avg_wait": self.total_wait / started if started > 0 else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+    async def run(self, guild_id: int, priority: Priority, request: Callable[[], Awaitable[T]]) -> T:
+        """ Waits for a free slot then awaits request(), retrying it if we get rate limited """
+        self.submitted += 1
+
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(guild_id, priority)
+            try:
+                result = await request()
+            except openai.RateLimitError as e:
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    raise
+                self._backoff(e, attempt)
+            except BaseException:
+                self.failed += 1
+                raise
+            else:
+                self.completed += 1
+                self._limit = min(self.max_concurrent, self._limit + 1)
+                return result
+            finally:
+                self._release(guild_id)
+
+    def _can_start(self, guild_id: int) -> bool:
+        return self._active < self._limit and self._active_guilds.get(guild_id, 0) < self.max_per_guild
+
+    async def _acquire(self, guild_id: int, priority: Priority) -> None:
+        if not self._pending and time.monotonic() >= self._paused_until and self._can_start(guild_id):
+            self._start(guild_id)
+            return
+
+        if len(self._pending) >= self.max_queued:
+            # Make room by dropping the least important request, unless that would be this one
+            if self._pending[-1].priority <= priority:
+                self.rejected += 1
+                raise QueueFull("Too many AI requests are queued")
+
+            dropped = self._pending.pop()
+            self.rejected += 1
+            dropped.future.set_exception(QueueFull("Dropped for a higher priority AI request"))
+
+        self._seq += 1
+        job = _Job(priority, self._seq, guild_id, time.monotonic(), asyncio.get_running_loop().create_future())
+        bisect.insort(self._pending, job)
+        self._pump()
+
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            if job.future.done() and not job.future.cancelled() and job.future.exception() is None:
+                # We were given a slot but are not going to use it
+                self._release(guild_id)
+            elif job in self._pending:
+                self._pending.remove(job)
+            raise
+
+        wait = time.monotonic() - job.enqueued
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def _start(self, guild_id: int) -> None:
+        self._active += 1
+        self._active_guilds[guild_id] = self._active_guilds.get(guild_id, 0) + 1
+
+    def _release(self, guild_id: int) -> None:
+        self._active -= 1
+        active = self._active_guilds.pop(guild_id) - 1
+        if active:
+            self._active_guilds[guild_id] = active
+        self._pump()
+
+    def _pump(self) -> None:
+        """ Starts waiting requests in priority order while there are free slots """
+        now = time.monotonic()
+        if now < self._paused_until:
+            if self._resume is None:
+                self._resume = asyncio.get_running_loop().call_later(self._paused_until - now, self._resume_pump)
+            return
+
+        for job in list(self._pending):
+            if self._active >= self._limit:
+                break
+            if not self._can_start(job.guild_id):
+                continue
+
+            self._pending.remove(job)
+            self._start(job.guild_id)
+            job.future.set_result(None)
+
+    def _resume_pump(self) -> None:
+        self._resume = None
+        self._pump()
+
+    def _backoff(self, error: openai.RateLimitError, attempt: int) -> None:
+        self.rate_limited += 1
+
+        try:
+            delay = float(error.response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            delay = min(60, 2 ** attempt)
+
+        self._limit = max(1, self._limit // 2)
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        if self._resume is not None:
+            self._resume.cancel()
+            self._resume = None
+        logger.warning('Rate limited by OpenAI, pausing requests for %.1fs with a limit of %d', delay, self._limit)
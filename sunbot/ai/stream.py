@@ -0,0 +1,66 @@
+import contextlib
+import time
+from typing import AsyncContextManager, Awaitable, Callable, Optional
+
+import openai
+from openai.types.chat import ChatCompletionChunk
+
+
+class CompletionStream:
+    """ Shows a streamed chat completion progressively, by calling update with the text received so far
+
+        Used as an async context manager, the typing indicator is shown from entering until the first
+        text is shown. Updates are sent at most once every interval seconds to stay inside rate limits.
+
+        Attributes:
+            update (Callable[[str], Awaitable[None]]): Called with the full text so far whenever it should be shown
+            interval (float): The minimum time in seconds between updates
+            text (str): The text received so far
+    """
+
+    def __init__(
+        self,
+        update: Callable[[str], Awaitable[None]],
+        interval: float,
+        typing: Optional[AsyncContextManager] = None,
+    ) -> None:
+        self.update = update
+        self.interval = interval
+        self.text = ""
+
+        self._typing = typing
+        self._stack = contextlib.AsyncExitStack()
+        self._shown = ""
+
+    async def __aenter__(self) -> 'CompletionStream':
+        if self._typing is not None:
+            await self._stack.enter_async_context(self._typing)
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self._stack.aclose()
+
+    async def _show(self, text: str) -> None:
+        # Discord stops the typing indicator itself once we post, but we'd otherwise keep re-triggering it
+        await self._stack.aclose()
+        await self.update(text)
+        self._shown = text
+
+    async def consume(self, request: Awaitable[openai.AsyncStream[ChatCompletionChunk]]) -> str:
+        """ Awaits a streamed completion request and shows it as it comes in, returning the full text """
+        self.text = ""
+        last_update = 0.0
+
+        async with await request as stream:
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+
+                self.text += chunk.choices[0].delta.content
+                if time.monotonic() - last_update >= self.interval:
+                    await self._show(self.text)
+                    last_update = time.monotonic()
+
+        if self.text and self.text != self._shown:
+            await self._show(self.text)
+        return self.text
@@ -1,34 +1,166 @@
-import os
+from __future__ import annotations
+import time
+import asyncio
+import importlib
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import aiohttp
 import hikari
-import lavalink
 import lightbulb
-import sentry_sdk
-from lightbulb.ext import tasks
 from sunbot.config import CONFIG
 from sunbot.db.base import database
 from sunbot.db.models.guild import Guild
-from sunbot.lavalink.events import EventHandler
+from sunbot.utils.dispatch import MessageDispatcher
+from sunbot.utils.gateway import cache_settings, check_gateway, resolve_gateway
+from sunbot.utils.http import create_httpx_client, create_session
+from sunbot.utils.metrics import BotInstruments, MetricsRegistry, MetricsServer, flatten_stats
+from sunbot.utils.rest import RESTScheduler
+from sunbot.utils.startup import StartupTimer
+from sunbot.utils.tracing import TracePolicy, fail_current_transaction, init_sentry, plugin_name, trace, trace_listener
+
+# Optional features are only imported when they are configured
+if TYPE_CHECKING:
+    import httpx
+    import lavalink
+    from sunbot.lavalink.search import TrackSearchCache
+    from sunbot.lavalink.telemetry import PlaybackTelemetry
+
+logger = logging.getLogger(__name__)
+
+# Guild available events are collected until none arrive for this many seconds, then written together
+GUILD_BOOTSTRAP_DEBOUNCE = 1
+GUILD_BOOTSTRAP_MAX_WAIT = 10
+# A batch that fails to be written is retried, backing off up to this many seconds between attempts
+GUILD_BOOTSTRAP_MAX_BACKOFF = 300
+
+PLUGINS_PATH = Path("sunbot/plugins")
+# Plugins that need an optional feature, these aren't imported at all unless it is configured
+PLUGIN_FEATURES = {
+    "sunbot.plugins.fun.ai": "openai",
+    "sunbot.plugins.fun.punishment": "lavalink",
+    "sunbot.plugins.music.music": "lavalink",
+}
+
+
+def enabled_features() -> Set[str]:
+    features = set()
+    if CONFIG.openai and CONFIG.openai.api_key:
+        features.add("openai")
+    if CONFIG.lavalink and CONFIG.lavalink.get_nodes():
+        features.add("lavalink")
+    return features
+
+
+def discover_plugins() -> List[str]:
+    """ The plugin modules to load, those needing a feature that isn't configured are skipped """
+    features = enabled_features()
+    plugins = []
+    for path in sorted(PLUGINS_PATH.glob("*/*.py")):
+        if path.name.startswith("_"):
+            continue
+
+        module = ".".join(path.with_suffix("").parts)
+        feature = PLUGIN_FEATURES.get(module)
+        if feature is not None and feature not in features:
+            logger.info('Skipping plugin %s as %s is not configured', module, feature)
+            continue
+        plugins.append(module)
+    return plugins
 
 
 class Sunbot(lightbulb.BotApp):
 
     def __init__(self) -> None:
+        # Set up before lightbulb subscribes its own listeners, so those are instrumented too
+        self.metrics = MetricsRegistry()
+        self.instruments = BotInstruments(self.metrics)
+        self.metrics_server: MetricsServer | None = None
+        self.tracing: TracePolicy | None = None
+        self._instrumented: Dict[Tuple[type, Callable], Callable] = {}
+
+        self.startup = StartupTimer()
+
+        # Only the events and cache the loaded plugins use, anything more costs bandwidth and memory
+        self._plugin_modules = discover_plugins()
+        gateway = resolve_gateway(CONFIG.gateway, self._plugin_modules)
+
         super().__init__(
             token=CONFIG.discord_token,
             ignore_bots=True,
             prefix=None,
-            intents=hikari.Intents.ALL,
+            intents=gateway.intents,
+            cache_settings=cache_settings(CONFIG.gateway, gateway.cache),
             default_enabled_guilds=CONFIG.default_guilds
         )
 
+        # Checked once hikari has set up logging
+        logger.info('Requesting intents %s, caching %s', gateway.intents, gateway.cache)
+        check_gateway(gateway, self._plugin_modules)
+
         self.lavalink: lavalink.Client | None = None
+        self.track_search: TrackSearchCache | None = None
+        self.playback: PlaybackTelemetry | None = None
+
+        # Shared HTTP clients, these pool connections so plugins should use them rather than creating their own
+        self.http: aiohttp.ClientSession | None = None
+        self.httpx: httpx.AsyncClient | None = None
+
+        # Plugins register message handlers here rather than each listening for every message
+        self.messages = MessageDispatcher()
+        # Plugins make REST calls through this so the important ones aren't stuck behind the rest
+        self.rest_scheduler = RESTScheduler(
+            rate=CONFIG.rest.rate,
+            burst=CONFIG.rest.burst,
+            low_reserve=CONFIG.rest.low_reserve,
+            low_max_delay=CONFIG.rest.low_max_delay,
+        )
+
+        self.metrics.add_collector("rest", lambda: flatten_stats("rest", self.rest_scheduler.stats(), "priority"))
+        self.metrics.add_collector("messages", lambda: flatten_stats("message_handler", self.messages.stats(), "handler"))
+
+        self._known_guilds: Set[int] = set()
+        self._pending_guilds: Set[int] = set()
+        self._guild_bootstrap: Optional[asyncio.Task] = None
+        self._guild_bootstrap_failures = 0
+
+    def subscribe(self, event_type: type, callback: Callable[[Any], Awaitable[None]]) -> None:
+        instrumented = trace_listener(event_type, self.instruments.wrap_listener(event_type, callback))
+        self._instrumented[(event_type, callback)] = instrumented
+        super().subscribe(event_type, instrumented)
+
+    def unsubscribe(self, event_type: type, callback: Callable[[Any], Awaitable[None]]) -> None:
+        super().unsubscribe(event_type, self._instrumented.pop((event_type, callback), callback))
+
+    async def invoke_application_command(self, context: lightbulb.context.ApplicationContext) -> None:
+        self.instruments.commands_in_flight.inc()
+        started = time.perf_counter()
+        failed = False
+
+        # Commands are run from lightbulb's interaction listener, but are traced on their own
+        plugin = plugin_name(context.command.callback.__module__)
+        with trace("command", context.command.qualname, plugin, new_transaction=True) as transaction:
+            try:
+                await super().invoke_application_command(context)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                duration = time.perf_counter() - started
+                self.instruments.commands_in_flight.dec()
+                # The subcommand is only known once the context has been invoked
+                command = (context.invoked or context.command).qualname
+                self.instruments.command_duration.observe(duration, command=command)
+                if self.tracing is not None and transaction is not None:
+                    self.tracing.finish_command(transaction, command, duration, failed)
 
     def run(self) -> None:
-        self.event_manager.subscribe(hikari.StartingEvent, self.on_starting)
-        self.event_manager.subscribe(hikari.StartedEvent, self.on_started)
-        self.event_manager.subscribe(hikari.StoppingEvent, self.on_stopping)
-        self.event_manager.subscribe(lightbulb.CommandErrorEvent, self.on_command_error)
-        self.event_manager.subscribe(hikari.GuildAvailableEvent, self.on_guild_available)
+        self.subscribe(hikari.StartingEvent, self.on_starting)
+        self.subscribe(hikari.StartedEvent, self.on_started)
+        self.subscribe(hikari.StoppedEvent, self.on_stopped)
+        self.subscribe(lightbulb.CommandErrorEvent, self.on_command_error)
+        self.subscribe(hikari.GuildAvailableEvent, self.on_guild_available)
+        self.subscribe(hikari.GuildMessageCreateEvent, self.on_guild_message)
 
         super().run(
             activity=hikari.Activity(
@@ -37,39 +169,98 @@ class Sunbot(lightbulb.BotApp):
         )
 
     async def on_starting(self, event: hikari.StartingEvent):
+        # Configure sentry if available, first so that errors during startup are reported
+        if CONFIG.sentry and CONFIG.sentry.dsn:
+            with self.startup.phase("sentry"):
+                self.tracing = init_sentry(CONFIG.sentry)
+
+        self.http = create_session(CONFIG.http)
+        if "openai" in enabled_features():
+            self.httpx = create_httpx_client(CONFIG.http)
+
+        # None of these depend on each other, and the gateway doesn't connect until they are done
+        await asyncio.gather(
+            self.startup.run("database", self.connect_database()),
+            self.startup.run("lavalink", self.setup_lavalink()),
+            self.startup.run("metrics", self.start_metrics()),
+        )
+        self.startup.start("gateway")
+
+    async def connect_database(self):
         await database.connect()
+        self._known_guilds.update(await Guild.objects.values_list("id", flatten=True))
 
-        # Configure sentry if available
-        if CONFIG.sentry and CONFIG.sentry.dsn:
-            sentry_sdk.init(
-                dsn=CONFIG.sentry.dsn,
-                traces_sample_rate=1.0
-            )
+    async def start_metrics(self):
+        if CONFIG.metrics and CONFIG.metrics.port:
+            self.metrics_server = MetricsServer(self.metrics, CONFIG.metrics.host, CONFIG.metrics.port)
+            await self.metrics_server.start()
 
-    async def on_started(self, event: hikari.StartedEvent):
-        # Configure Lavalink if available
-        if CONFIG.lavalink and CONFIG.lavalink.host:
-            self.lavalink = lavalink.Client(self.get_me().id)
+    async def setup_lavalink(self):
+        """ Connects to the Lavalink nodes, if configured, so they are ready by the time the gateway is """
+        if "lavalink" not in enabled_features():
+            return
+
+        import lavalink
+        from sunbot.lavalink.events import EventHandler
+        from sunbot.lavalink.nodes import LoadBalancedNodeManager
+        from sunbot.lavalink.search import TrackSearchCache
+        from sunbot.lavalink.telemetry import PlaybackTelemetry
+
+        # The gateway isn't up yet so get_me() isn't available
+        me = await self.rest.fetch_my_user()
+
+        self.lavalink = lavalink.Client(me.id)
+        self.lavalink.node_manager = LoadBalancedNodeManager(self.lavalink)
+        for i, node in enumerate(CONFIG.lavalink.get_nodes()):
             self.lavalink.add_node(
-                host=CONFIG.lavalink.host,
-                port=CONFIG.lavalink.port,
-                password=CONFIG.lavalink.password,
-                region='au',
-                name='default-node'
+                host=node.host,
+                port=node.port,
+                password=node.password,
+                region=node.region,
+                name=node.name or f'node-{i}',
+                ssl=node.ssl
             )
-            self.lavalink.add_event_hooks(EventHandler())
+        self.playback = PlaybackTelemetry(
+            history=CONFIG.lavalink.telemetry_history,
+            max_guilds=CONFIG.lavalink.telemetry_max_guilds,
+        )
+        self.lavalink.add_event_hooks(EventHandler(self.playback))
+        self.track_search = TrackSearchCache(
+            self.lavalink,
+            maxsize=CONFIG.lavalink.search_cache_size,
+            ttl=CONFIG.lavalink.search_cache_ttl,
+            telemetry=self.playback,
+        )
+        self.metrics.add_collector("track_search", lambda: flatten_stats("track_search", self.track_search.stats()))
+        self.metrics.add_collector("playback", self.playback.export)
 
-        # Load Extensions
-        for folder in os.listdir("sunbot/plugins"):
-            self.load_extensions_from(os.path.join("sunbot/plugins/", folder))
+    async def on_started(self, event: hikari.StartedEvent):
+        self.startup.finish("gateway")
+
+        # Imported on the loop thread, a worker thread gains nothing as importing holds the GIL
+        with self.startup.phase("plugin imports"):
+            for plugin in self._plugin_modules:
+                importlib.import_module(plugin)
+        with self.startup.phase("plugins"):
+            self.load_extensions(*self._plugin_modules)
 
-        tasks.load(self)
+        self.startup.report()
 
-    async def on_stopping(self, event: hikari.StoppingEvent):
+    async def on_stopped(self, event: hikari.StoppedEvent):
+        # Plugins flush their state in StoppingEvent, which hikari finishes before StoppedEvent
         await database.disconnect()
 
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+
+        if self.http is not None:
+            await self.http.close()
+        if self.httpx is not None:
+            await self.httpx.aclose()
+
     async def on_command_error(self, event: lightbulb.CommandErrorEvent):
         exc = event.exception
+        self.instruments.record_command_error((event.context.invoked or event.context.command).qualname, exc)
 
         if isinstance(exc, lightbulb.NotOwner):
             await event.context.respond(
@@ -100,6 +291,9 @@ class Sunbot(lightbulb.BotApp):
             # Assume that the check logs a good error
             return
 
+        # Unexpected errors always keep the command's trace
+        fail_current_transaction()
+
         await event.context.respond(
             embed=hikari.Embed(
                     description="Something went wrong",
@@ -108,6 +302,52 @@ class Sunbot(lightbulb.BotApp):
             )
         raise event.exception
 
+    async def on_guild_message(self, event: hikari.GuildMessageCreateEvent):
+        await self.messages.dispatch(event, self.get_me().id)
+
     async def on_guild_available(self, event: hikari.GuildAvailableEvent):
         # Ensure that there is a Guild Node for every guild we join
-        await Guild.objects.get_or_create(id=event.guild_id)
+        if event.guild_id in self._known_guilds:
+            return
+
+        self._pending_guilds.add(event.guild_id)
+        if self._guild_bootstrap is None:
+            self._guild_bootstrap = asyncio.create_task(self.bootstrap_guilds())
+
+    async def bootstrap_guilds(self, delay: float = 0):
+        """ Creates Guild rows for newly available guilds in a single batch once events have settled """
+        await asyncio.sleep(delay)
+        started = time.perf_counter()
+
+        # Keep waiting while guilds are still coming in, up to the max wait
+        seen = 0
+        while len(self._pending_guilds) != seen and time.perf_counter() - started < GUILD_BOOTSTRAP_MAX_WAIT:
+            seen = len(self._pending_guilds)
+            await asyncio.sleep(GUILD_BOOTSTRAP_DEBOUNCE)
+
+        # Anything arriving from here on starts a new batch
+        pending = self._pending_guilds
+        self._pending_guilds = set()
+        self._guild_bootstrap = None
+
+        try:
+            existing = await Guild.objects.filter(id__in=list(pending)).values_list("id", flatten=True)
+            new_guilds = pending.difference(existing)
+            if new_guilds:
+                await Guild.objects.bulk_create([Guild(id=guild_id) for guild_id in new_guilds])
+        except Exception:
+            # Put the batch back, rows that reference these guilds can't be written until they exist
+            self._pending_guilds |= pending
+            self._guild_bootstrap_failures += 1
+            retry = min(GUILD_BOOTSTRAP_MAX_BACKOFF, GUILD_BOOTSTRAP_DEBOUNCE * 2 ** self._guild_bootstrap_failures)
+            logger.exception('Failed to bootstrap %d guilds, retrying in %ds', len(pending), retry)
+            if self._guild_bootstrap is None:
+                self._guild_bootstrap = asyncio.create_task(self.bootstrap_guilds(retry))
+            return
+
+        self._guild_bootstrap_failures = 0
+        self._known_guilds.update(pending)
+        logger.info(
+            'Bootstrapped %d guilds (%d new) in %.2fs',
+            len(pending), len(new_guilds), time.perf_counter() - started
+        )
@@ -5,16 +5,58 @@ from dataclass_wizard import JSONFileWizard
 
 
 @dataclass
-class LavalinkConfig:
-    """ Holds the configuration for connecting to a LavaLink Instance
+class LavalinkNodeConfig:
+    """ Holds the configuration for connecting to a single LavaLink node
         Attributes:
             host (str): The hostname to connect to
             password (str): Password to use when connecting
             port (int): The port to connect to, defaults to 2333
+            region (str): The region the node is in, one of asia, eu or us. Players are placed on nodes in their region first
+            name (str): The name of the node, used in logs
+            ssl (bool): Whether to connect with SSL
     """
     host: str
     password: str
     port: int = 2333
+    region: str = None
+    name: str = None
+    ssl: bool = False
+
+
+@dataclass
+class LavalinkConfig:
+    """ Holds the configuration for connecting to a LavaLink Instance
+        Attributes:
+            host (str): The hostname to connect to, for a single node
+            password (str): Password to use when connecting, for a single node
+            port (int): The port to connect to, defaults to 2333, for a single node
+            nodes (list[LavalinkNodeConfig]): The nodes to connect to, used as well as host if both are set
+            search_cache_size (int): The number of track lookups to cache across all guilds
+            search_cache_ttl (int): Time in seconds a track lookup is cached for
+            max_queue_size (int): The maximum number of songs that can be queued in a guild
+            snapshot_interval (int): Time in seconds between saving queues so they can be restored after a restart
+            idle_timeout (int): Time in seconds to stay in an empty voice channel before leaving
+            telemetry_history (int): The number of samples kept in each playback telemetry series
+            telemetry_max_guilds (int): The number of guilds playback telemetry is kept for
+    """
+    host: str = None
+    password: str = None
+    port: int = 2333
+    nodes: List[LavalinkNodeConfig] = field(default_factory=list)
+    search_cache_size: int = 1024
+    search_cache_ttl: int = 3600
+    max_queue_size: int = 500
+    snapshot_interval: int = 15
+    idle_timeout: int = 60
+    telemetry_history: int = 360
+    telemetry_max_guilds: int = 500
+
+    def get_nodes(self) -> List[LavalinkNodeConfig]:
+        """ All the configured nodes, including the single node set with host """
+        nodes = list(self.nodes)
+        if self.host:
+            nodes.insert(0, LavalinkNodeConfig(self.host, self.password, self.port, region='au', name='default-node'))
+        return nodes
 
 
 @dataclass
@@ -37,6 +79,8 @@ class OpenAIAutoRandomConfig:
         context_poll (int): The time to wait for more context messages to come in
         context_timeout (int): The maximum time we will wait before sending an auto reply
         max_tokens (str): The max length of tokens to respond with
+        context_token_budget (int): The maximum number of prompt tokens to send as context
+        max_images (int): The maximum number of images to send to vision models
     """
 
     min_length: int = 10
@@ -46,6 +90,8 @@ class OpenAIAutoRandomConfig:
     context_poll: int = 30
     context_timeout: int = 120
     max_tokens: int = 300
+    context_token_budget: int = 3000
+    max_images: int = 2
 
 
 @dataclass
@@ -55,11 +101,15 @@ class OpenAIAutoReplyConfig:
         pre_context_time (int): Time in seconds to get messages before the selected one
         pre_context_limit (int): The maximum amount of messages to send
         max_tokens (str): The max length of tokens to respond with
+        context_token_budget (int): The maximum number of prompt tokens to send as context
+        max_images (int): The maximum number of images to send to vision models
     """
 
     pre_context_limit: int = 100
     pre_context_time: int = 120
     max_tokens: int = 300
+    context_token_budget: int = 4000
+    max_images: int = 4
 
 
 @dataclass
@@ -70,6 +120,10 @@ class OpenAIAutoConfig:
         completions_model (str): The completion model to use
         random (OpenAIAutoRandomConfig): Config for Random Responses
         reploy (OpenAIAutoReplyConfig): Config for Replies/Mentions
+        history_channel_size (int): The number of recent messages to keep in memory per channel
+        history_max_messages (int): The total number of messages to keep in memory across all channels
+        image_max_edge (int): Images sent to vision models are downscaled so no side is longer than this
+        image_cache_size (int): The number of downscaled images to keep in memory
     """
 
     system_context: List[str] = (
@@ -81,12 +135,32 @@ class OpenAIAutoConfig:
     completions_model: str = "gpt-4-vision-preview"
     random: OpenAIAutoRandomConfig = field(default_factory=OpenAIAutoRandomConfig)
     reply: OpenAIAutoReplyConfig = field(default_factory=OpenAIAutoReplyConfig)
+    history_channel_size: int = 200
+    history_max_messages: int = 20000
+    image_max_edge: int = 512
+    image_cache_size: int = 256
 
     @property
     def use_vision(self) -> bool:
         return 'vision' in self.completions_model.lower()
 
 
+@dataclass
+class OpenAICacheConfig:
+    """ Config for caching responses to the askgpt and genimage commands
+
+        directory (str): Directory to store cached responses and images in
+        ttl (int): Time in seconds a cached response is reused for
+        max_bytes (int): The maximum size of the cache directory
+        memory_size (int): The number of responses to also keep in memory
+    """
+
+    directory: str = ".cache/openai"
+    ttl: int = 86400
+    max_bytes: int = 512 * 1024 * 1024
+    memory_size: int = 256
+
+
 @dataclass
 class OpenAIConfig:
     """ Holds configuration for the openai module
@@ -96,6 +170,11 @@ class OpenAIConfig:
             genimage_max_images (int): The maximum images you can ask chatGPT to generate
             ask_max_tokens (int): The max number of tokens open AI will respond to the ask command
             ask_completions_model (str): The Completion model to use for the ask command
+            max_concurrent_requests (int): The maximum number of requests to OpenAI running at once
+            max_concurrent_requests_per_guild (int): The maximum number of requests running at once for a single guild
+            max_queued_requests (int): The maximum number of requests waiting to be sent before new ones are rejected
+            stream_edit_interval (float): The minimum time in seconds between edits while a response is streamed in
+            cache (OpenAICacheConfig): Config for caching command responses
             auto (OpenAIAutoConfig): Config for auto responses
     """
 
@@ -104,6 +183,11 @@ class OpenAIConfig:
     genimage_max_images: int = 4
     ask_max_tokens: int = 500
     ask_completions_model: str = "gpt-4-vision-preview"
+    max_concurrent_requests: int = 4
+    max_concurrent_requests_per_guild: int = 2
+    max_queued_requests: int = 50
+    stream_edit_interval: float = 1.5
+    cache: OpenAICacheConfig = field(default_factory=OpenAICacheConfig)
     auto: OpenAIAutoConfig = field(default_factory=OpenAIAutoConfig)
 
     @property
@@ -111,9 +195,87 @@ class OpenAIConfig:
         return 'vision' in self.completions_model.lower()
 
 
+@dataclass
+class HTTPConfig:
+    """ Holds configuration for the HTTP clients shared by plugins
+        Attributes:
+            timeout (float): The total time in seconds a request may take
+            connect_timeout (float): The time in seconds to wait for a connection to be established
+            max_connections (int): The maximum number of open connections across all hosts
+            max_connections_per_host (int): The maximum number of open connections to a single host
+            keepalive_timeout (float): Time in seconds an idle connection is kept open for reuse
+            dns_cache_ttl (int): Time in seconds resolved hostnames are cached for
+    """
+    timeout: float = 60
+    connect_timeout: float = 10
+    max_connections: int = 100
+    max_connections_per_host: int = 10
+    keepalive_timeout: float = 30
+    dns_cache_ttl: int = 300
+
+
+@dataclass
+class RESTConfig:
+    """ Holds configuration for prioritising REST calls to Discord
+        Attributes:
+            rate (float): The number of calls per second the local budget refills by
+            burst (int): The maximum budget that can build up
+            low_reserve (float): Budget that low priority calls (i.e. jokes and nicknames) can't use
+            low_max_delay (float): Time in seconds a low priority call may wait before it is dropped
+    """
+    rate: float = 10
+    burst: int = 20
+    low_reserve: float = 10
+    low_max_delay: float = 5
+
+
+@dataclass
+class MetricsConfig:
+    """ Holds the configuration for the Prometheus metrics endpoint
+        Attributes:
+            port (int): The port to serve /metrics on, metrics are not served if this isn't set
+            host (str): The address to listen on, defaults to only local connections
+    """
+    port: int = None
+    host: str = "127.0.0.1"
+
+
+@dataclass
+class GatewayConfig:
+    """ Holds the configuration for the gateway intents and what hikari caches
+        Attributes:
+            intents (list[str]): The intents to request by hikari name, i.e. GUILD_MESSAGES, derived from the plugins if not set
+            cache_components (list[str]): The cache components to enable by hikari name, i.e. VOICE_STATES, derived from the plugins if not set
+            max_messages (int): The number of messages kept in the message cache, when it is enabled
+            max_dm_channel_ids (int): The number of DM channel IDs cached
+    """
+    intents: List[str] = None
+    cache_components: List[str] = None
+    max_messages: int = 300
+    max_dm_channel_ids: int = 50
+
+
 @dataclass
 class SentryConfig:
+    """ Holds the configuration for reporting to Sentry
+        Attributes:
+            dsn (str): The DSN to report to, nothing is reported if this isn't set
+            sample_rate (float): The fraction of errors to report, defaults to all of them
+            traces_sample_rate (float): The fraction of commands to trace that were neither slow nor failed
+            listener_sample_rate (float): The fraction of event listener calls to trace
+            chatty_listener_sample_rate (float): The fraction of listener calls to trace for frequent events, i.e. messages
+            slow_command_threshold (float): Time in seconds after which a command is always traced
+            health_commands (list[str]): Commands that are never traced
+            max_events_per_minute (int): The most errors, and separately the most transactions, sent each minute
+    """
     dsn: str = None
+    sample_rate: float = 1.0
+    traces_sample_rate: float = 0.1
+    listener_sample_rate: float = 0.05
+    chatty_listener_sample_rate: float = 0.001
+    slow_command_threshold: float = 2.0
+    health_commands: List[str] = field(default_factory=lambda: ["ping", "sunbot info"])
+    max_events_per_minute: int = 60
 
 
 @dataclass
@@ -122,8 +284,12 @@ class Config(JSONFileWizard):
     discord_token: str
     database: DatabaseConfig
     sentry: SentryConfig = None
+    metrics: MetricsConfig = None
     openai: OpenAIConfig = None
     lavalink: LavalinkConfig = None
+    http: HTTPConfig = field(default_factory=HTTPConfig)
+    rest: RESTConfig = field(default_factory=RESTConfig)
+    gateway: GatewayConfig = field(default_factory=GatewayConfig)
     default_guilds: List[int] = ()
 
 
@@ -0,0 +1,21 @@
+from typing import List
+import ormar
+from sunbot.db.base import base_ormar_config
+from sunbot.db.models.guild import Guild
+
+
+class QueueSnapshot(ormar.Model):
+
+    ormar_config = base_ormar_config.copy(
+        tablename="queue_snapshots"
+    )
+
+    id: int = ormar.Integer(primary_key=True, autoincrement=True)
+    guild: Guild = ormar.ForeignKey(Guild, related_name="queue_snapshot", unique=True)
+    channel: int = ormar.BigInteger()
+    # [encoded track, requester] pairs, starting with the track that was playing
+    tracks: List = ormar.JSON()
+    # Position in milliseconds of the track that was playing
+    position: int = ormar.BigInteger(default=0)
+    # Unix timestamp the snapshot was last written at
+    updated: int = ormar.BigInteger()
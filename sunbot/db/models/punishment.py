@@ -25,3 +25,19 @@ class PunishmentSong(ormar.Model):
     guild: Guild = ormar.ForeignKey(Guild, related_name="punishment_songs")
     name: str = ormar.String(max_length=255)
     url: str = ormar.String(max_length=255)
+    # Encoded Lavalink track resolved from the url, so it can be played without searching again
+    track: str = ormar.Text(nullable=True, default=None)
+
+
+class ActivePunishment(ormar.Model):
+
+    ormar_config = base_ormar_config.copy(
+        tablename="punishments",
+        constraints=[ormar.UniqueColumns("guild", "user")]
+    )
+
+    id: int = ormar.Integer(primary_key=True, autoincrement=True)
+    guild: Guild = ormar.ForeignKey(Guild, related_name="active_punishments")
+    user: int = ormar.BigInteger()
+    # Unix timestamp the punishment ends at
+    expires: int = ormar.BigInteger()
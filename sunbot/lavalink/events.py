@@ -1,24 +1,71 @@
 import logging
 import lavalink
 
+from sunbot.lavalink.telemetry import PlaybackTelemetry
+
 logger = logging.getLogger(__name__)
 
 
 class EventHandler:
-    """Events from the Lavalink server"""
+    """Events from the Lavalink server, recorded to telemetry as well as logged"""
+
+    def __init__(self, telemetry: PlaybackTelemetry) -> None:
+        self.telemetry = telemetry
 
     @lavalink.listener(lavalink.TrackStartEvent)
     async def track_start(self, event: lavalink.TrackStartEvent):
         logger.info('Track started on guild: %s', event.player.guild_id)
+        self.telemetry.record_track_start(event.player.guild_id)
 
     @lavalink.listener(lavalink.TrackEndEvent)
     async def track_end(self, event: lavalink.TrackEndEvent):
         logger.info('Track finished on guild: %s', event.player.guild_id)
+        self.telemetry.record_track_end(event.player.guild_id)
 
     @lavalink.listener(lavalink.TrackExceptionEvent)
     async def track_exception(self, event: lavalink.TrackExceptionEvent):
-        logger.warning('Track exception event happened on guild: %d', event.player.guild_id)
+        logger.warning('Track exception event happened on guild: %d (%s: %s)', event.player.guild_id, event.severity, event.message)
+        self.telemetry.record_exception(event.player.guild_id, event.severity or 'unknown')
+
+    @lavalink.listener(lavalink.TrackStuckEvent)
+    async def track_stuck(self, event: lavalink.TrackStuckEvent):
+        logger.warning('Track stuck for %dms on guild: %d', event.threshold, event.player.guild_id)
+        self.telemetry.record_stuck(event.player.guild_id)
 
     @lavalink.listener(lavalink.QueueEndEvent)
     async def queue_finish(self, event: lavalink.QueueEndEvent):
         logger.info('Queue finished on guild: %s', event.player.guild_id)
+        self.telemetry.record_queue_end(event.player.guild_id)
+
+    @lavalink.listener(lavalink.PlayerUpdateEvent)
+    async def player_update(self, event: lavalink.PlayerUpdateEvent):
+        self.telemetry.record_player_update(event.player.guild_id, event.connected, event.ping)
+
+    @lavalink.listener(lavalink.WebSocketClosedEvent)
+    async def voice_closed(self, event: lavalink.WebSocketClosedEvent):
+        logger.info('Voice websocket closed on guild: %s (%s: %s)', event.player.guild_id, event.code, event.reason)
+        self.telemetry.record_voice_closed(event.player.guild_id)
+
+    @lavalink.listener(lavalink.IncomingWebSocketMessage)
+    async def websocket_message(self, event: lavalink.IncomingWebSocketMessage):
+        # lavalink.py doesn't raise an event for stats, so they are picked out of the raw messages
+        if event.data.get('op') == 'stats':
+            self.telemetry.record_node_stats(event.node.name, event.data)
+
+    @lavalink.listener(lavalink.NodeConnectedEvent)
+    async def node_connected(self, event: lavalink.NodeConnectedEvent):
+        logger.info('Lavalink node %s connected', event.node.name)
+
+    @lavalink.listener(lavalink.NodeDisconnectedEvent)
+    async def node_disconnected(self, event: lavalink.NodeDisconnectedEvent):
+        logger.warning(
+            'Lavalink node %s disconnected (%s: %s), moving %d players',
+            event.node.name, event.code, event.reason, len(event.node.players)
+        )
+
+    @lavalink.listener(lavalink.NodeChangedEvent)
+    async def node_changed(self, event: lavalink.NodeChangedEvent):
+        logger.info(
+            'Moved player for guild %s from node %s to %s',
+            event.player.guild_id, event.old_node.name, event.new_node.name
+        )
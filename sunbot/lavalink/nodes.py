@@ -0,0 +1,77 @@
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional
+
+import lavalink
+from lavalink.nodemanager import NodeManager
+
+logger = logging.getLogger(__name__)
+
+# The number of recent node selections kept for inspection
+DECISION_HISTORY = 50
+# Penalty lavalink.py gives nodes that are unavailable or haven't sent stats
+UNAVAILABLE_PENALTY = 9e30
+
+
+@dataclass
+class NodeDecision:
+    """ A record of a node being chosen for a player
+        Attributes:
+            time (float): Unix timestamp of the decision
+            region (str): The region that was asked for
+            node (str): The name of the node chosen, None if no node was available
+            loads (Dict[str, float]): The load of each candidate node at the time
+    """
+    time: float
+    region: Optional[str]
+    node: Optional[str]
+    loads: Dict[str, float]
+
+
+def node_load(node: lavalink.Node) -> float:
+    """ The load of a node, lavalink.py's penalty but counting the players on the node now
+
+        Stats only arrive once a minute, so without this every player created in that minute
+        would be placed on the same node.
+    """
+    penalty = node.penalty
+    if penalty >= UNAVAILABLE_PENALTY:
+        return penalty
+    return penalty - node.stats.playing_players + len(node.players)
+
+
+def least_loaded_node(nodes: List[lavalink.Node]) -> Optional[lavalink.Node]:
+    """ The node with the lowest load, without recording a decision, i.e. for track searches """
+    return min(nodes, key=node_load, default=None)
+
+
+class LoadBalancedNodeManager(NodeManager):
+    """ Places players on the least loaded node in their region, and keeps a record of each decision
+
+        Attributes:
+            decisions (Deque[NodeDecision]): The most recent node selections
+    """
+    __slots__ = ('decisions',)
+
+    def __init__(self, client: lavalink.Client, regions=None, connect_back: bool = False) -> None:
+        super().__init__(client, regions, connect_back)
+        self.decisions: Deque[NodeDecision] = deque(maxlen=DECISION_HISTORY)
+
+    def find_ideal_node(self, region: str = None, exclude: Optional[List[lavalink.Node]] = None) -> Optional[lavalink.Node]:
+        exclusions = exclude or []
+        candidates = [node for node in self.available_nodes if node not in exclusions]
+
+        # Prefer nodes in the region, but any node will do if there are none
+        nodes = [node for node in candidates if region and node.region == region] or candidates
+
+        loads = {node.name: node_load(node) for node in nodes}
+        best = min(nodes, key=lambda node: loads[node.name]) if nodes else None
+
+        self.decisions.append(NodeDecision(time.time(), region, best.name if best else None, loads))
+        if best is None:
+            logger.warning('No Lavalink node available for region %s', region)
+        else:
+            logger.debug('Chose Lavalink node %s for region %s, loads: %s', best.name, region, loads)
+        return best
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import re
+import time
+from typing import Dict, Optional
+
+import lavalink
+
+from sunbot.lavalink.nodes import least_loaded_node
+from sunbot.lavalink.telemetry import PlaybackTelemetry
+from sunbot.utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+SEARCH_PREFIX_RX = re.compile(r'^(\w+search):(.*)$', re.IGNORECASE)
+
+# Only results that found something are worth keeping, errors and empty searches are retried next time
+CACHEABLE_LOAD_TYPES = (lavalink.LoadType.TRACK, lavalink.LoadType.PLAYLIST, lavalink.LoadType.SEARCH)
+
+
+def normalize_query(query: str) -> str:
+    """ Normalizes a query so equivalent searches share a cache entry, URLs are left alone as they can be case sensitive """
+    query = query.strip()
+    if match := SEARCH_PREFIX_RX.match(query):
+        return f"{match.group(1).lower()}:{' '.join(match.group(2).casefold().split())}"
+    return query
+
+
+def copy_result(result: lavalink.LoadResult) -> lavalink.LoadResult:
+    """ Copies the tracks in a result, players and plugins set the requester and extras on tracks """
+    tracks = [type(track)(track, **track.extra) for track in result.tracks]
+    return lavalink.LoadResult(result.load_type, tracks, result.playlist_info, result.plugin_info, result.error)
+
+
+class TrackSearchCache:
+    """ Caches Lavalink track lookups across all guilds
+
+        Identical lookups that happen at the same time share a single request to Lavalink.
+
+        Attributes:
+            client (lavalink.Client): The client to load tracks with
+            cache (TTLCache): The cached results, keyed by normalized query
+            coalesced (int): The number of lookups that waited on an identical lookup already in flight
+            telemetry (PlaybackTelemetry): Where the time taken by lookups that reach Lavalink is recorded, optional
+    """
+
+    def __init__(self, client: lavalink.Client, maxsize: int, ttl: int, telemetry: Optional[PlaybackTelemetry] = None) -> None:
+        self.client = client
+        self.telemetry = telemetry
+        self.cache: TTLCache[str, lavalink.LoadResult] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.coalesced = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def get_tracks(self, query: str) -> lavalink.LoadResult:
+        """ Gets the tracks for a query, the same as lavalink.Client.get_tracks """
+        key = normalize_query(query)
+
+        result = self.cache.get(key)
+        if result is None:
+            inflight = self._inflight.get(key)
+            if inflight is not None:
+                self.coalesced += 1
+            else:
+                inflight = self._inflight[key] = asyncio.ensure_future(self._load(key, query))
+                inflight.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+            # Shielded so one caller being cancelled doesn't cancel the lookup for the others
+            result = await asyncio.shield(inflight)
+
+        return copy_result(result)
+
+    def invalidate(self, query: str) -> None:
+        """ Drops the cached result for a query, i.e. when one of its tracks has stopped playing """
+        self.cache.invalidate(normalize_query(query))
+
+    async def _load(self, key: str, query: str) -> lavalink.LoadResult:
+        started = time.perf_counter()
+        # Without a node lavalink.py picks one at random, which may be down. Searches aren't placements,
+        # so they don't go through find_ideal_node and fill its decision history
+        node = least_loaded_node(self.client.node_manager.available_nodes)
+        result = await self.client.get_tracks(query, node=node)
+        if self.telemetry is not None:
+            self.telemetry.record_track_load(time.perf_counter() - started)
+        if result.load_type in CACHEABLE_LOAD_TYPES and result.tracks:
+            self.cache.set(key, result)
+        return result
+
+    def stats(self) -> Dict[str, float]:
+        return {**self.cache.stats(), "coalesced": self.coalesced}
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import lavalink
+
+from sunbot.db.models.music import QueueSnapshot
+
+logger = logging.getLogger(__name__)
+
+
+class QueueSnapshots:
+    """ Periodically saves each guild's queue and playback position so they survive a restart
+
+        Only what changed since the last save is written, a queue that hasn't changed only has its
+        position updated, and a paused player isn't written at all.
+
+        Attributes:
+            client (lavalink.Client): The client whose players are saved
+            interval (int): Time in seconds between saves
+            pending (Set[int]): Guilds with a saved queue that hasn't been restored yet
+            writes (int): The number of snapshot writes made
+    """
+
+    def __init__(self, client: lavalink.Client, interval: int) -> None:
+        self.client = client
+        self.interval = interval
+        self.pending: Set[int] = set()
+        self.writes = 0
+
+        # guild -> (hash of the saved tracks, saved position)
+        self._saved: Dict[int, Tuple[int, int]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """ Stops saving, after a final save so positions are as fresh as possible """
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        self._task = None
+        try:
+            await self.save_all()
+        except Exception:
+            logger.exception('Failed to save queue snapshots before stopping')
+
+    async def load(self) -> None:
+        self.pending = set(await QueueSnapshot.objects.values_list("guild", flatten=True))
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save_all()
+            except Exception:
+                logger.exception('Failed to save queue snapshots')
+
+    @staticmethod
+    def _tracks(player: lavalink.DefaultPlayer) -> Optional[List[Tuple[str, int]]]:
+        tracks = ([player.current] if player.current else []) + list(player.queue)
+
+        # Punishment songs take over the player, those aren't a queue worth keeping
+        if any('punishment_song' in track.extra for track in tracks):
+            return None
+        return [(track.track, track.requester) for track in tracks]
+
+    async def save_all(self) -> None:
+        players = self.client.player_manager.players
+        for guild_id, player in list(players.items()):
+            await self.save(guild_id, player)
+
+        # Players that have been destroyed since the last save
+        for guild_id in set(self._saved).difference(players):
+            await self.delete(guild_id)
+
+    async def save(self, guild_id: int, player: lavalink.DefaultPlayer) -> None:
+        tracks = self._tracks(player) if player.is_connected else None
+        if not tracks:
+            if guild_id in self._saved:
+                await self.delete(guild_id)
+            return
+
+        fingerprint = hash(tuple(tracks))
+        position = int(player.position)
+
+        saved = self._saved.get(guild_id)
+        if saved == (fingerprint, position):
+            return
+
+        if saved is not None and saved[0] == fingerprint:
+            await QueueSnapshot.objects.filter(guild=guild_id).update(position=position, updated=int(time.time()))
+        else:
+            snapshot = await QueueSnapshot.objects.get_or_none(guild=guild_id)
+            values = dict(channel=player.channel_id, tracks=tracks, position=position, updated=int(time.time()))
+            if snapshot is None:
+                await QueueSnapshot.objects.create(guild=guild_id, **values)
+            else:
+                await snapshot.update(**values)
+
+        self._saved[guild_id] = (fingerprint, position)
+        self.pending.discard(guild_id)
+        self.writes += 1
+
+    async def delete(self, guild_id: int) -> None:
+        await QueueSnapshot.objects.filter(guild=guild_id).delete()
+        self._saved.pop(guild_id, None)
+        self.pending.discard(guild_id)
+
+    async def get(self, guild_id: int) -> Optional[QueueSnapshot]:
+        return await QueueSnapshot.objects.get_or_none(guild=guild_id)
+
+    async def restore(self, player: lavalink.DefaultPlayer, snapshot: QueueSnapshot) -> None:
+        """ Re-queues a saved queue on a player, and resumes the track that was playing where it left off """
+        self.pending.discard(snapshot.guild.id)
+        if not snapshot.tracks:
+            return
+
+        # Decode the whole queue in a single request
+        decoded = await player.node.decode_tracks([encoded for encoded, _ in snapshot.tracks])
+        for track, (_, requester) in zip(decoded, snapshot.tracks):
+            track.requester = requester
+
+        current, *queue = decoded
+        for track in queue:
+            player.add(track)
+        await player.play(current, start_time=snapshot.position)
+
+        logger.info('Restored %d queued tracks in guild %d', len(decoded), snapshot.guild.id)
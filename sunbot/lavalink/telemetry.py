@@ -0,0 +1,147 @@
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from sunbot.utils.metrics import Metric
+from sunbot.utils.series import TimeSeries
+
+# The values recorded from each Lavalink stats message, by the name they are kept under
+NODE_STATS = {
+    "players": ("players",),
+    "playing_players": ("playingPlayers",),
+    "system_load": ("cpu", "systemLoad"),
+    "lavalink_load": ("cpu", "lavalinkLoad"),
+    "frames_sent": ("frameStats", "sent"),
+    "frames_nulled": ("frameStats", "nulled"),
+    "frames_deficit": ("frameStats", "deficit"),
+}
+
+
+def _lookup(data: Dict[str, Any], path: Tuple[str, ...]) -> Optional[float]:
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data if isinstance(data, (int, float)) else None
+
+
+class PlayerHealth:
+    """ What has happened to a single guild's player
+        Attributes:
+            ping (TimeSeries): The voice ping reported in each player update, in milliseconds
+            disconnects (int): Player updates that reported the voice connection as down
+            voice_closes (int): Times Discord closed the voice websocket
+            exceptions (int): Tracks that failed to play
+            stuck (int): Tracks that got stuck while playing
+            connected (bool): Whether the voice connection was up in the last player update
+    """
+
+    def __init__(self, history: int) -> None:
+        self.ping = TimeSeries(history)
+        self.disconnects = 0
+        self.voice_closes = 0
+        self.exceptions = 0
+        self.stuck = 0
+        self.connected = True
+
+
+class PlaybackTelemetry:
+    """ Keeps bounded time series of Lavalink node stats and player health so stutter can be traced to a cause
+
+        Attributes:
+            history (int): The number of samples kept in each series
+            max_guilds (int): The number of guilds player health is kept for, the least recently updated are dropped
+            nodes (Dict[str, Dict[str, TimeSeries]]): The series for each node, keyed by node name then stat
+            guilds (OrderedDict[int, PlayerHealth]): The player health of each guild
+            track_loads (TimeSeries): Time in seconds taken to load tracks from Lavalink
+            start_gaps (TimeSeries): Time in seconds between a track ending and the next one starting
+            exceptions (Counter[str]): Track failures by severity, stuck tracks are counted as stuck
+    """
+
+    def __init__(self, history: int, max_guilds: int) -> None:
+        self.history = history
+        self.max_guilds = max_guilds
+        self.nodes: Dict[str, Dict[str, TimeSeries]] = {}
+        self.guilds: OrderedDict[int, PlayerHealth] = OrderedDict()
+        self.track_loads = TimeSeries(history)
+        self.start_gaps = TimeSeries(history)
+        self.exceptions: Counter[str] = Counter()
+
+        # guild -> when its last track ended
+        self._ended: Dict[int, float] = {}
+
+    def guild(self, guild_id: int) -> PlayerHealth:
+        health = self.guilds.get(guild_id)
+        if health is None:
+            health = self.guilds[guild_id] = PlayerHealth(self.history)
+            if len(self.guilds) > self.max_guilds:
+                stale, _ = self.guilds.popitem(last=False)
+                self._ended.pop(stale, None)
+        else:
+            self.guilds.move_to_end(guild_id)
+        return health
+
+    def record_node_stats(self, node: str, data: Dict[str, Any]) -> None:
+        """ Records a stats message sent by a Lavalink node """
+        series = self.nodes.setdefault(node, {})
+        now = time.time()
+        for name, path in NODE_STATS.items():
+            value = _lookup(data, path)
+            if value is not None:
+                series.setdefault(name, TimeSeries(self.history)).record(value, now)
+
+    def record_player_update(self, guild_id: int, connected: bool, ping: int) -> None:
+        health = self.guild(guild_id)
+        health.ping.record(ping)
+        # Only count the change from connected to disconnected, updates keep coming while it is down
+        if health.connected and not connected:
+            health.disconnects += 1
+        health.connected = connected
+
+    def record_voice_closed(self, guild_id: int) -> None:
+        self.guild(guild_id).voice_closes += 1
+
+    def record_track_load(self, seconds: float) -> None:
+        self.track_loads.record(seconds)
+
+    def record_track_end(self, guild_id: int) -> None:
+        self._ended[guild_id] = time.monotonic()
+
+    def record_track_start(self, guild_id: int) -> None:
+        ended = self._ended.pop(guild_id, None)
+        if ended is not None:
+            self.start_gaps.record(time.monotonic() - ended)
+
+    def record_queue_end(self, guild_id: int) -> None:
+        # Nothing follows the last track, so there is no gap to measure
+        self._ended.pop(guild_id, None)
+
+    def record_exception(self, guild_id: int, severity: str) -> None:
+        self.exceptions[severity.lower()] += 1
+        self.guild(guild_id).exceptions += 1
+
+    def record_stuck(self, guild_id: int) -> None:
+        self.exceptions["stuck"] += 1
+        self.guild(guild_id).stuck += 1
+
+    def export(self) -> List[Metric]:
+        """ The latest value of everything recorded, as metrics """
+        metrics: List[Metric] = []
+        for node, series in self.nodes.items():
+            for name, values in series.items():
+                metrics.append((f"lavalink_node_{name}", {"node": node}, values.latest))
+
+        for name, series in (("lavalink_track_load_seconds", self.track_loads), ("lavalink_track_start_gap_seconds", self.start_gaps)):
+            for stat, value in series.summary().items():
+                metrics.append((name, {"stat": stat}, value))
+
+        for severity, count in self.exceptions.items():
+            metrics.append(("lavalink_track_exceptions_total", {"severity": severity}, count))
+
+        for guild_id, health in self.guilds.items():
+            labels = {"guild": str(guild_id)}
+            if health.ping.latest is not None:
+                metrics.append(("lavalink_player_ping_ms", labels, health.ping.latest))
+            metrics.append(("lavalink_player_disconnects_total", labels, health.disconnects))
+            metrics.append(("lavalink_player_voice_closes_total", labels, health.voice_closes))
+        return metrics
@@ -77,9 +77,13 @@ class LavalinkVoice(VoiceConnection):
         self.__is_alive = False
 
         self.player.queue.clear()
+        self.player.set_loop(self.player.LOOP_NONE)
         await self.player.stop()
         await self.__on_close(self)
 
+        # Players are only kept for guilds that are listening to something
+        await self.lavalink.player_manager.destroy(self.__guild_id)
+
     async def join(self) -> None:
         """Wait for the process to halt before continuing."""
 
@@ -126,7 +130,8 @@ class LavalinkVoice(VoiceConnection):
         **kwargs: t.Any,
     ) -> LavalinkVoice:
         lavalink_client: lavalink.Client = kwargs["lavalink_client"]
-        player = lavalink_client.player_manager.create(guild_id)
+        # The endpoint tells lavalink.py which region to pick a node in
+        player = lavalink_client.player_manager.create(guild_id, endpoint=endpoint[6:])
 
         await player._voice_state_update({
             'user_id': user_id,
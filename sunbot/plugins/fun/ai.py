@@ -1,8 +1,10 @@
+import asyncio
+import base64
 import logging
 import random
 import time
 from datetime import timedelta
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 from typing import List, Dict, Optional, Sequence
 from collections import defaultdict
 
@@ -10,14 +12,22 @@ import aiohttp
 import hikari
 import lightbulb
 from hikari import Message
-from lightbulb.ext import tasks
 import openai
-
-from sunbot.config import CONFIG
+from openai.types import Image
+
+from sunbot.ai.cache import ResponseCache
+from sunbot.ai.context import build_context, get_encoding
+from sunbot.ai.history import HistoryMessage, MessageHistory
+from sunbot.ai.images import AttachmentImages
+from sunbot.ai.queue import AIRequestQueue, Priority, QueueFull
+from sunbot.ai.stream import CompletionStream
+from sunbot.config import CONFIG, OpenAIAutoRandomConfig, OpenAIAutoReplyConfig
+from sunbot.utils.dispatch import MessageFacts
+from sunbot.utils.metrics import flatten_stats
+from sunbot.utils.rest import RESTPriority, RESTScheduler
 
 logger = logging.getLogger(__name__)
 plugin = lightbulb.Plugin("OpenAI")
-client = openai.AsyncOpenAI(api_key=CONFIG.openai.api_key)
 
 
 @dataclass
@@ -26,127 +36,131 @@ class OpenAiRandomContext:
         Attributes:
             last_trigger (int): The unix timestamp of the last time a message was triggered
             target_message (Message): The message that caused triggered the response
-            messages (List[messages]): List of messages that happened while collecting context
             last_context (int): unix timestamp of the last time we collected a context message
+            timer (asyncio.TimerHandle): The pending timer that will send the response
+            task (asyncio.Task): The task sending the most recent response
     """
 
     last_trigger: int = 0
 
     target_message: Optional[Message] = None
-    messages: List[Message] = field(default_factory=list)
     last_context: int = 0
 
+    timer: Optional[asyncio.TimerHandle] = None
+    task: Optional[asyncio.Task] = None
+
+    @property
+    def deadline(self) -> int:
+        """ The unix timestamp the response should be sent at, either once context stops coming in or at the timeout """
+        return min(
+            self.last_trigger + CONFIG.openai.auto.random.context_timeout,
+            self.last_context + CONFIG.openai.auto.random.context_poll
+        )
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
     def reset(self):
+        self.cancel_timer()
         self.target_message = None
-        self.messages = list()
         self.last_context = 0
 
 
-def generate_messages(msgs: Sequence[Message]) -> List[Dict]:
-    """ Given a sequence of messages, generate the chat messgaes to send to OpenAI """
+async def generate_messages(msgs: Sequence[HistoryMessage], config: OpenAIAutoRandomConfig | OpenAIAutoReplyConfig) -> List[Dict]:
+    """ Given a sequence of messages, generate the chat messgaes to send to OpenAI within the mode's token budget """
+    return await build_context(
+        msgs,
+        CONFIG.openai.auto.system_context,
+        CONFIG.openai.auto.completions_model,
+        token_budget=config.context_token_budget,
+        max_images=config.max_images,
+        images=plugin.bot.d.openai_images,
+    )
 
-    me: hikari.OwnUser = plugin.bot.get_me()
-    chat_messages = []
 
-    # Incldue the context messages from the config
-    for msg in CONFIG.openai.auto.system_context:
-        chat_messages.append({
-            "role": "system",
-            "content": msg,
-        })
+def schedule_auto_response(guild_id: int, octx: OpenAiRandomContext):
+    """ (Re)arms the timer that sends the auto response for a guild """
+    octx.cancel_timer()
+    delay = max(0, octx.deadline - time.time())
+    octx.timer = asyncio.get_running_loop().call_later(delay, start_auto_response, guild_id)
 
-    for msg in msgs:
-        if msg.content is None:
-            continue
 
-        role = 'assistant' if msg.author.id == me.id else 'user'
-        content = msg.content
+def start_auto_response(guild_id: int):
+    octx: OpenAiRandomContext = plugin.bot.d.openai[guild_id]
+    octx.timer = None
+    octx.task = asyncio.create_task(auto_response(guild_id))
 
-        # Replace any user mentions with thier username
-        if msg.user_mentions:
-            for user in msg.user_mentions.values():
-                content = content.replace(f'<@{user.id}>', f'@{user.username}')
 
-        if role == 'user':
-            content = f'{msg.author.username}({msg.author.id}): {content}'
+async def auto_response(guild_id: int):
+    """ Do the auto response """
 
-        # If we are using a vision, we need to workout if there are any images included
-        if CONFIG.openai.auto.use_vision:
-            content = [
-                 {"type": "text", "text": content},
-            ]
+    octx: OpenAiRandomContext = plugin.bot.d.openai[guild_id]
+    if octx.target_message is None:
+        return
 
-            for attach in msg.attachments:
-                if not attach.media_type.lower().startswith('image'):
-                    continue
+    target_message = octx.target_message
+    cutoff = target_message.created_at - timedelta(seconds=CONFIG.openai.auto.random.pre_context_time)
+    history: MessageHistory = plugin.bot.d.openai_history
+    chat_messages = await generate_messages(await history.get(target_message.channel_id, after=cutoff), CONFIG.openai.auto.random)
 
-                content.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": attach.url,
-                    }
-                })
+    # Reset now so that messages arriving while we generate aren't collected, last_trigger keeps the cooldown
+    octx.reset()
 
-        chat_messages.append({
-            "role": role,
-            "content": content
-        })
+    logger.info(f'Generating reponse to {target_message.id}')
 
-    return chat_messages
+    client: openai.AsyncOpenAI = plugin.bot.d.openai_client
+    queue: AIRequestQueue = plugin.bot.d.openai_queue
+    try:
+        response = await queue.run(guild_id, Priority.RANDOM, lambda: client.chat.completions.create(
+            model=CONFIG.openai.auto.completions_model,
+            max_tokens=CONFIG.openai.auto.random.max_tokens,
+            messages=chat_messages
+        ))
+        await plugin.bot.rest_scheduler.run(RESTPriority.NORMAL, lambda: plugin.bot.rest.create_message(
+            target_message.channel_id, response.choices[0].message.content
+        ))
+    except QueueFull as e:
+        logger.warning(f"Skipping automatic response: {e}")
+    except openai.OpenAIError as e:
+        logger.exception(f"Failed to automatically respond due to OpenAi Error: {e}")
+        pass
 
 
-@tasks.task(s=10, auto_start=True)
-async def auto_repsonse():
-    """ Do the auto response """
+async def record_message(facts: MessageFacts):
+    """ Keeps the message history up to date, this is registered first so it runs before the other handlers """
+    plugin.bot.d.openai_history.add(facts.message)
 
-    all_context: Dict[int, OpenAiRandomContext] = plugin.bot.d.openai
 
-    now = time.time()
+@plugin.listener(hikari.GuildMessageUpdateEvent)
+async def record_message_edit(event: hikari.GuildMessageUpdateEvent):
+    plugin.bot.d.openai_history.update(event.message)
 
-    for _, octx in all_context.items():
-        if octx.target_message is None:
-            return
 
-        # If we are below both the timeout and last poll phase then wait some more
-        if now < (octx.last_trigger + CONFIG.openai.auto.random.context_timeout):
-            if now < (octx.last_context + CONFIG.openai.auto.random.context_poll):
-                return
+@plugin.listener(hikari.GuildMessageDeleteEvent)
+async def record_message_delete(event: hikari.GuildMessageDeleteEvent):
+    plugin.bot.d.openai_history.delete(event.channel_id, event.message_id)
 
-        logger.info(f'Generating reponse to {octx.target_message.id}')
 
-        chat_messages = generate_messages(octx.messages)
+@plugin.listener(hikari.GuildBulkMessageDeleteEvent)
+async def record_message_bulk_delete(event: hikari.GuildBulkMessageDeleteEvent):
+    plugin.bot.d.openai_history.delete(event.channel_id, *event.message_ids)
 
-        try:
-            response = await client.chat.completions.create(
-                model=CONFIG.openai.auto.completions_model,
-                max_tokens=CONFIG.openai.auto.random.max_tokens,
-                messages=chat_messages
-            )
-            await plugin.bot.rest.create_message(octx.target_message.channel_id, response.choices[0].message.content)
-        except openai.OpenAIError as e:
-            logger.exception(f"Failed to automatically respond due to OpenAi Error: {e}")
-            pass
 
-        octx.reset()
+def is_auto_response_candidate(facts: MessageFacts) -> bool:
+    # If this message is a reply to us, or mentions us, then it is handled by on_mention_me
+    return not facts.reply_to_me and not facts.mentions_me
 
 
-@plugin.listener(hikari.GuildMessageCreateEvent)
-async def auto_response_on_message(event: hikari.GuildMessageCreateEvent):
+async def auto_response_on_message(facts: MessageFacts):
     """ Handler to listen for messages that could be automatically replied too """
-    if event.is_bot or event.content is None:
-        return
-
-    message: hikari.Message = event.message
-    me: hikari.OwnUser = plugin.bot.get_me()
-
-    # If this message is a reply to us, or mentions us, then we aren't interested
-    if (message.type == hikari.MessageType.REPLY and message.referenced_message.author.id == me.id) or \
-       (me.id in message.user_mentions_ids):
-        return
+    event = facts.event
+    message: hikari.Message = facts.message
 
     octx: OpenAiRandomContext = plugin.bot.d.openai[event.guild_id]
     if octx.target_message is None:
-        if len(message.content.split()) < CONFIG.openai.auto.random.min_length:
+        if facts.word_count < CONFIG.openai.auto.random.min_length:
             return
 
         if octx.last_trigger > (int(time.time()) - CONFIG.openai.auto.random.cooldown):
@@ -160,53 +174,64 @@ async def auto_response_on_message(event: hikari.GuildMessageCreateEvent):
         octx.last_trigger = int(time.time())
         octx.last_context = octx.last_trigger
         octx.target_message = message
-
-        cutoff = message.created_at - timedelta(seconds=CONFIG.openai.auto.random.pre_context_time)
-        msgs = await plugin.bot.rest.fetch_messages(event.channel_id, after=cutoff)
-        octx.messages.extend(msgs)
+        schedule_auto_response(event.guild_id, octx)
 
     else:
         # In a different channel, not part of the "Conversation"
         if event.channel_id != octx.target_message.channel_id:
             return
 
-        octx.messages.append(message)
+        # The message itself is picked up from the history when the response is sent
         octx.last_context = int(time.time())
+        schedule_auto_response(event.guild_id, octx)
 
 
-@plugin.listener(hikari.GuildMessageCreateEvent)
-async def on_mention_me(event: hikari.GuildMessageCreateEvent):
+def is_mention(facts: MessageFacts) -> bool:
+    # Only reply when we are mentioned, and if it is a reply it has to be to us
+    return facts.mentions_me and (not facts.is_reply or facts.reply_to_me)
 
-    if event.is_bot or event.content is None:
-        return
 
-    message: hikari.Message = event.message
-    me: hikari.OwnUser = plugin.bot.get_me()
-
-    # If this message isn't a reply to us, or mentions us, then we aren't interested
-    if (message.type == hikari.MessageType.REPLY and message.referenced_message.author.id != me.id) or \
-       (me.id not in message.user_mentions_ids):
-        return
+async def on_mention_me(facts: MessageFacts):
+    event = facts.event
+    message: hikari.Message = facts.message
 
     # If this is a reply to an earlier message, than use the original message
-    if (message.type == hikari.MessageType.REPLY):
+    if facts.is_reply:
         message = message.referenced_message
 
     # Otherwise let's gather some context and reply to it
     cufoff = message.created_at - timedelta(seconds=CONFIG.openai.auto.reply.pre_context_time)
-    msgs = plugin.bot.rest.fetch_messages(event.channel_id, after=cufoff).limit(
-        CONFIG.openai.auto.reply.pre_context_limit
-    )
-
-    chat_messages = generate_messages(await msgs)
-
+    history: MessageHistory = plugin.bot.d.openai_history
+    msgs = await history.get(event.channel_id, after=cufoff, limit=CONFIG.openai.auto.reply.pre_context_limit)
+
+    chat_messages = await generate_messages(msgs, CONFIG.openai.auto.reply)
+
+    # Post the reply once the first text comes in, then keep editing it as the rest arrives
+    reply: Optional[hikari.Message] = None
+
+    async def show_reply(text: str):
+        nonlocal reply
+        scheduler: RESTScheduler = plugin.bot.rest_scheduler
+        if reply is None:
+            reply = await scheduler.run(RESTPriority.NORMAL, lambda: plugin.bot.rest.create_message(
+                event.channel_id, text, reply=event.message_id
+            ))
+        else:
+            await scheduler.run(RESTPriority.NORMAL, lambda: plugin.bot.rest.edit_message(event.channel_id, reply, text))
+
+    client: openai.AsyncOpenAI = plugin.bot.d.openai_client
+    queue: AIRequestQueue = plugin.bot.d.openai_queue
     try:
-        response = await client.chat.completions.create(
-            model=CONFIG.openai.auto.completions_model,
-            max_tokens=CONFIG.openai.auto.reply.max_tokens,
-            messages=chat_messages
-        )
-        await plugin.bot.rest.create_message(event.channel_id, response.choices[0].message.content, reply=event.message_id)
+        typing = plugin.bot.rest.trigger_typing(event.channel_id)
+        async with CompletionStream(show_reply, CONFIG.openai.stream_edit_interval, typing) as stream:
+            await queue.run(event.guild_id, Priority.REPLY, lambda: stream.consume(client.chat.completions.create(
+                model=CONFIG.openai.auto.completions_model,
+                max_tokens=CONFIG.openai.auto.reply.max_tokens,
+                messages=chat_messages,
+                stream=True
+            )))
+    except QueueFull as e:
+        logger.warning(f"Skipping reply to mention: {e}")
     except openai.OpenAIError as e:
         logger.exception(f"Failed to automatically respond due to OpenAi Error: {e}")
         pass
@@ -214,24 +239,49 @@ async def on_mention_me(event: hikari.GuildMessageCreateEvent):
 
 @plugin.command
 @lightbulb.add_cooldown(CONFIG.openai.command_cooldown, 1, lightbulb.UserBucket)
+@lightbulb.option("fresh", "Generate a new response even if this was asked recently", type=bool, default=False, required=False)
 @lightbulb.option("prompt", "The Prompt to send to ChatGPT")
 @lightbulb.command("askgpt", "Ask a question to OpenAI", pass_options=True)
 @lightbulb.implements(lightbulb.commands.SlashCommand)
-async def askgpt(ctx: lightbulb.context.SlashContext, prompt: str):
+async def askgpt(ctx: lightbulb.context.SlashContext, prompt: str, fresh: bool):
     embed = hikari.Embed(
         title=prompt,
         description="Please wait generating response",
         color=hikari.Colour(0x2ECC71)
     ).add_field('Requestor', f"<@{ctx.user.id}>")
+
+    cache: ResponseCache = ctx.bot.d.openai_cache
+    cache_key = ResponseCache.key(
+        "askgpt", prompt,
+        model=CONFIG.openai.ask_completions_model,
+        max_tokens=CONFIG.openai.ask_max_tokens
+    )
+
+    # Empty responses may have been cached before they were rejected, don't serve them
+    if not fresh and (text := await cache.get_text(cache_key)):
+        embed.description = text
+        embed.set_footer("Cached response, use fresh to generate a new one")
+        await ctx.respond(embed=embed)
+        return
+
     await ctx.respond(embed=embed)
 
+    async def show_response(text: str):
+        embed.description = text
+        await ctx.edit_last_response(embed=embed)
+
+    client: openai.AsyncOpenAI = ctx.bot.d.openai_client
+    queue: AIRequestQueue = ctx.bot.d.openai_queue
     try:
-        completion = await openai.Completion.acreate(
-            model=CONFIG.openai.ask_completions_model,
-            max_tokens=CONFIG.openai.ask_max_tokens,
-            prompt=prompt
-        )
-    except openai.OpenAIError as e:
+        typing = ctx.bot.rest.trigger_typing(ctx.channel_id)
+        async with CompletionStream(show_response, CONFIG.openai.stream_edit_interval, typing) as stream:
+            text = await queue.run(ctx.guild_id, Priority.COMMAND, lambda: stream.consume(client.chat.completions.create(
+                model=CONFIG.openai.ask_completions_model,
+                max_tokens=CONFIG.openai.ask_max_tokens,
+                messages=[{"role": "user", "content": prompt}],
+                stream=True
+            )))
+    except (openai.OpenAIError, QueueFull) as e:
         await ctx.edit_last_response(
            embed=hikari.Embed(
                 description=f"Failed to send request to ChatGPT: {e}",
@@ -240,56 +290,100 @@ async def askgpt(ctx: lightbulb.context.SlashContext, prompt: str):
         )
         return
 
-    embed.description = completion.choices[0].text
-    await ctx.edit_last_response(embed=embed)
+    if not text:
+        await ctx.edit_last_response(
+            embed=hikari.Embed(
+                description="ChatGPT didn't return a response, please try again",
+                color=hikari.Colour(0xd32f2f)
+            )
+        )
+        return
+
+    await cache.set_text(cache_key, text)
 
 
 @plugin.command
 @lightbulb.add_cooldown(CONFIG.openai.command_cooldown, 1, lightbulb.UserBucket)
 @lightbulb.option("size", "The size of the image to generate", default="1024x1024", choices=["256x256", "512x512", "1024x1024"])
 @lightbulb.option("number", "Number of images to generate", default=4, type=int, required=False, max_value=CONFIG.openai.genimage_max_images)
+@lightbulb.option("fresh", "Generate new images even if this was asked for recently", type=bool, default=False, required=False)
 @lightbulb.option("prompt", "The Prompt to send to ChatGPT")
 @lightbulb.command("genimage", "Generates an image using OpenAI", pass_options=True)
 @lightbulb.implements(lightbulb.commands.SlashCommand)
-async def genimage(ctx: lightbulb.context.SlashContext, prompt: str, number: int, size: str):
+async def genimage(ctx: lightbulb.context.SlashContext, prompt: str, number: int, size: str, fresh: bool):
     embed = hikari.Embed(
         title=prompt,
         description="Please wait generating response",
         color=hikari.Colour(0x2ECC71),
         url="https://openai.com"
     ).add_field('Requestor', f"<@{ctx.user.id}>")
-    resp = await ctx.respond(embed=embed)
+    await ctx.respond(embed=embed)
 
-    try:
-        images = await openai.Image.acreate(
-            n=number,
-            prompt=prompt,
-            size=size
-        )
-    except openai.OpenAIError as e:
-        await ctx.edit_last_response(
-           embed=hikari.Embed(
-                description=f"Failed to generate images: {e}",
-                color=hikari.Colour(0xd32f2f)
+    cache: ResponseCache = ctx.bot.d.openai_cache
+    cache_key = ResponseCache.key("genimage", prompt, number=number, size=size)
+    generate_time = download_time = 0.0
+
+    image_files = None if fresh else await cache.get_images(cache_key)
+    if image_files is not None:
+        image_data = [hikari.File(image) for image in image_files]
+        embed.set_footer("Cached images, use fresh to generate new ones")
+    else:
+        client: openai.AsyncOpenAI = ctx.bot.d.openai_client
+        queue: AIRequestQueue = ctx.bot.d.openai_queue
+        started = time.perf_counter()
+        try:
+            images = await queue.run(ctx.guild_id, Priority.COMMAND, lambda: client.images.generate(
+                n=number,
+                prompt=prompt,
+                size=size,
+                response_format="b64_json"
+            ))
+            generate_time = time.perf_counter() - started
+
+            started = time.perf_counter()
+            image_bytes = await asyncio.gather(*[download_image(ctx.bot.http, image) for image in images.data])
+            download_time = time.perf_counter() - started
+        except (openai.OpenAIError, QueueFull, aiohttp.ClientError) as e:
+            await ctx.edit_last_response(
+               embed=hikari.Embed(
+                    description=f"Failed to generate images: {e}",
+                    color=hikari.Colour(0xd32f2f)
+                )
             )
-        )
-        return
+            return
 
-    image_data = []
-    async with aiohttp.ClientSession() as session:
-        for image in images.data:
-            async with session.get(image['url']) as response:
-                image_data.append(await response.read())
+        # Upload straight from the cached files, the same as a cache hit
+        if (image_files := await cache.set_images(cache_key, image_bytes)) is not None:
+            image_data = [hikari.File(image) for image in image_files]
+        else:
+            image_data = [hikari.Bytes(data, f"image{i}.png") for i, data in enumerate(image_bytes)]
 
-    await ctx.edit_last_response(embed=None, content="...")
+    # Embeds sharing a url are shown together as a gallery, so send them all in one edit
     embed.description = None
-
+    embeds = []
     for image in image_data:
-        msg = await resp.message()
-        embed.set_image(image)
-        embeds = msg.embeds + [embed]
-        await msg.edit(embeds=embeds)
-    await ctx.edit_last_response(content=None)
+        if embeds:
+            embed = hikari.Embed(url="https://openai.com")
+        embeds.append(embed.set_image(image))
+
+    started = time.perf_counter()
+    await ctx.edit_last_response(embeds=embeds)
+    upload_time = time.perf_counter() - started
+
+    logger.info(
+        'genimage for %s: generate %.2fs, download %.2fs, upload %.2fs',
+        ctx.user.id, generate_time, download_time, upload_time
+    )
+
+
+async def download_image(session: aiohttp.ClientSession, image: Image) -> bytes:
+    """ Returns the contents of a generated image, either decoding it from the response or fetching it from its url """
+    if image.b64_json is not None:
+        return await asyncio.to_thread(base64.b64decode, image.b64_json)
+
+    async with session.get(image.url) as response:
+        response.raise_for_status()
+        return await response.read()
 
 
 def load(bot: lightbulb.BotApp) -> None:
@@ -298,8 +392,52 @@ def load(bot: lightbulb.BotApp) -> None:
         return
 
     bot.add_plugin(plugin)
+    bot.d.openai_client = openai.AsyncOpenAI(api_key=CONFIG.openai.api_key, http_client=bot.httpx)
     bot.d.openai: Dict[int, OpenAiRandomContext] = defaultdict(lambda: OpenAiRandomContext())
+    bot.d.openai_queue = AIRequestQueue(
+        max_concurrent=CONFIG.openai.max_concurrent_requests,
+        max_per_guild=CONFIG.openai.max_concurrent_requests_per_guild,
+        max_queued=CONFIG.openai.max_queued_requests,
+    )
+    bot.d.openai_cache = ResponseCache(
+        CONFIG.openai.cache.directory,
+        ttl=CONFIG.openai.cache.ttl,
+        max_bytes=CONFIG.openai.cache.max_bytes,
+        memory_size=CONFIG.openai.cache.memory_size,
+    )
+    bot.d.openai_history = MessageHistory(
+        bot.rest,
+        bot.get_me().id,
+        use_vision=CONFIG.openai.auto.use_vision,
+        channel_size=CONFIG.openai.auto.history_channel_size,
+        max_messages=CONFIG.openai.auto.history_max_messages,
+    )
+    bot.d.openai_images = AttachmentImages(
+        bot.http,
+        max_edge=CONFIG.openai.auto.image_max_edge,
+        cache_size=CONFIG.openai.auto.image_cache_size,
+    )
+
+    # Record the message before the handlers that read the history run
+    bot.messages.register(record_message, include_bots=True, require_content=False)
+    bot.messages.register(auto_response_on_message, is_auto_response_candidate)
+    bot.messages.register(on_mention_me, is_mention)
+
+    bot.metrics.add_collector("openai_queue", lambda: flatten_stats("openai_queue", bot.d.openai_queue.stats()))
+    bot.metrics.add_collector("openai_images", lambda: flatten_stats("openai_images", bot.d.openai_images.stats()))
+
+    # Loading the tokenizer can download its data, so do it up front rather than on the first reply
+    asyncio.get_running_loop().run_in_executor(None, get_encoding, CONFIG.openai.auto.completions_model)
 
 
 def unload(bot: lightbulb.BotApp) -> None:
+    for handler in (record_message, auto_response_on_message, on_mention_me):
+        bot.messages.unregister(handler)
+    bot.metrics.remove_collector("openai_queue")
+    bot.metrics.remove_collector("openai_images")
+    for octx in bot.d.openai.values():
+        octx.cancel_timer()
+        # Otherwise a response in progress is still sent after the plugin is gone
+        if octx.task is not None:
+            octx.task.cancel()
     bot.remove_plugin(plugin)
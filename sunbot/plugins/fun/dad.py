@@ -3,6 +3,9 @@ import random
 import lightbulb
 import hikari
 
+from sunbot.utils.dispatch import MessageFacts
+from sunbot.utils.rest import RESTPriority, RESTScheduler
+
 
 plugin = lightbulb.Plugin("Dad")
 
@@ -10,32 +13,42 @@ plugin = lightbulb.Plugin("Dad")
 PATTERN = re.compile(r"\bi(?:'| +a|’)?m +([\w ]*)", re.IGNORECASE)
 
 
-@plugin.listener(hikari.GuildMessageCreateEvent)
-async def on_message(event: hikari.GuildMessageCreateEvent):
-    if event.is_bot or event.content is None:
+async def on_message(facts: MessageFacts):
+    # Roll first, it is much cheaper than searching every message
+    if random.random() < 0.8:
         return
 
-    if not (match := re.search(PATTERN, event.content)):
+    if not (match := re.search(PATTERN, facts.content)):
         return
-   
+
     name = match.group(1)
     if not name or len(name) > 32:
         return
 
-    if random.random() < 0.8:
+    event = facts.event
+    scheduler: RESTScheduler = plugin.bot.rest_scheduler
+    reply = await scheduler.run(RESTPriority.LOW, lambda: plugin.bot.rest.create_message(
+        event.channel_id, f"Hi {name}, I'm Sunbot!", reply=event.message_id, mentions_reply=True
+    ))
+    if reply is None:
         return
 
-    await plugin.bot.rest.create_message(event.channel_id, f"Hi {name}, I'm Sunbot!", reply=event.message_id, mentions_reply=True)
-
     try:
-        await plugin.bot.rest.edit_member(event.guild_id, event.author_id, nickname=name)
+        # Only the latest nickname matters if someone sets off several at once
+        await scheduler.run(
+            RESTPriority.LOW,
+            lambda: plugin.bot.rest.edit_member(event.guild_id, event.author_id, nickname=name),
+            key=("nickname", event.guild_id, event.author_id)
+        )
     except hikari.ForbiddenError:
         pass
 
 
 def load(bot: lightbulb.BotApp) -> None:
     bot.add_plugin(plugin)
+    bot.messages.register(on_message)
 
 
 def unload(bot: lightbulb.BotApp) -> None:
+    bot.messages.unregister(on_message)
     bot.remove_plugin(plugin)
@@ -1,18 +1,246 @@
-from typing import Dict, Optional
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+import asyncio
+import struct
 import time
 import logging
 import random
 import hikari
 import lightbulb
 import lavalink
-from sunbot.db.models.punishment import PunishmentConfig, PunishmentSong
+from sunbot.db.models.punishment import ActivePunishment, PunishmentConfig, PunishmentSong
 from sunbot.lavalink.voice import LavalinkVoice
+from sunbot.utils.cache import TTLCache
+from sunbot.utils.metrics import flatten_stats
+from sunbot.utils.rest import RESTPriority
+from sunbot.utils.scheduler import DeadlineScheduler
 
 logger = logging.getLogger(__name__)
 plugin = lightbulb.Plugin("Punishment")
 
 
 MAX_PUNISHMENT_TIME = 60
+SETTINGS_CACHE_SIZE = 1024
+SETTINGS_CACHE_TTL = 600
+
+
+@dataclass
+class PunishmentSettings:
+    """ Cached view of a guild's punishment config and songs
+        Attributes:
+            channel (int): The ID of the punishment channel, if one is configured
+            songs (List[PunishmentSong]): The songs that can be played in the punishment channel
+    """
+
+    channel: Optional[int] = None
+    songs: List[PunishmentSong] = field(default_factory=list)
+
+
+class PunishmentStore:
+    """ Holds the active punishments, persisted to the database and released when they expire
+        Attributes:
+            active (Dict[int, Dict[int, int]]): Map of guild ID to user ID to the unix timestamp the punishment ends
+            scheduler (DeadlineScheduler): Releases punishments at their expiry time
+    """
+
+    def __init__(self) -> None:
+        self.active: Dict[int, Dict[int, int]] = defaultdict(dict)
+        self.scheduler: DeadlineScheduler[Tuple[int, int]] = DeadlineScheduler(self._expire)
+        self._load_task: Optional[asyncio.Task] = None
+        # Adds and removes for the same user are serialised, so the database and active always agree
+        self._locks: Dict[Tuple[int, int], Tuple[asyncio.Lock, int]] = {}
+
+    def start(self) -> None:
+        self._load_task = asyncio.create_task(self.load())
+
+    def stop(self) -> None:
+        if self._load_task is not None:
+            self._load_task.cancel()
+        self.scheduler.stop()
+
+    async def load(self) -> None:
+        """ Loads the punishments from the database and starts expiring them """
+        try:
+            now = int(time.time())
+            await ActivePunishment.objects.filter(expires__lte=now).delete()
+
+            for punishment in await ActivePunishment.objects.all():
+                self._track(punishment.guild.id, punishment.user, punishment.expires)
+
+            logger.info('Loaded %d active punishments', len(self.scheduler))
+        except Exception:
+            logger.exception('Failed to load active punishments')
+        finally:
+            # Punishments added from now on still need to expire, even if the saved ones couldn't be loaded
+            self.scheduler.start()
+
+    def get(self, guild_id: int) -> Dict[int, int]:
+        return self.active.get(guild_id, {})
+
+    def is_punished(self, guild_id: int, user_id: int) -> bool:
+        return user_id in self.active.get(guild_id, {})
+
+    def _track(self, guild_id: int, user_id: int, expires: int) -> None:
+        self.active[guild_id][user_id] = expires
+        self.scheduler.schedule((guild_id, user_id), expires)
+
+    def _untrack(self, guild_id: int, user_id: int) -> None:
+        self.scheduler.cancel((guild_id, user_id))
+
+        punishments = self.active.get(guild_id)
+        if punishments is None:
+            return
+
+        punishments.pop(user_id, None)
+        if not punishments:
+            del self.active[guild_id]
+
+    @asynccontextmanager
+    async def _locked(self, key: Tuple[int, int]) -> AsyncIterator[None]:
+        lock, users = self._locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[key]
+            if users == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
+
+    async def add(self, guild_id: int, user_id: int, expires: int) -> None:
+        async with self._locked((guild_id, user_id)):
+            punishment = await ActivePunishment.objects.get_or_none(guild=guild_id, user=user_id)
+            if punishment is None:
+                await ActivePunishment.objects.create(guild=guild_id, user=user_id, expires=expires)
+            else:
+                await punishment.update(expires=expires)
+
+            self._track(guild_id, user_id, expires)
+
+    async def remove(self, guild_id: int, user_id: int) -> None:
+        async with self._locked((guild_id, user_id)):
+            await self._remove(guild_id, user_id)
+
+    async def _remove(self, guild_id: int, user_id: int) -> None:
+        self._untrack(guild_id, user_id)
+        await ActivePunishment.objects.filter(guild=guild_id, user=user_id).delete()
+
+    async def clear(self, guild_id: int) -> None:
+        for user_id in list(self.get(guild_id)):
+            self._untrack(guild_id, user_id)
+        await ActivePunishment.objects.filter(guild=guild_id).delete()
+
+    async def _expire(self, key: Tuple[int, int]) -> None:
+        guild_id, user_id = key
+        async with self._locked(key):
+            # The punishment may have been extended while waiting for the lock
+            expires = self.get(guild_id).get(user_id)
+            if expires is not None and expires > time.time():
+                return
+
+            logger.info('Punishment for user %d in guild %d has expired', user_id, guild_id)
+            await self._remove(guild_id, user_id)
+
+
+async def get_settings(guild_id: int) -> PunishmentSettings:
+    """ Gets the punishment settings for a guild, only hitting the database on a cache miss """
+
+    async def load_settings() -> PunishmentSettings:
+        config = await PunishmentConfig.objects.get_or_none(guild=guild_id)
+        songs = await PunishmentSong.objects.filter(guild=guild_id).all()
+        return PunishmentSettings(
+            channel=config.channel if config is not None else None,
+            songs=songs
+        )
+
+    cache: TTLCache[int, PunishmentSettings] = plugin.bot.d.punishment_settings
+    return await cache.get_or_load(guild_id, load_settings)
+
+
+def decode_song_track(song: PunishmentSong) -> Optional[lavalink.AudioTrack]:
+    """ Builds a playable track from the encoded track stored with the song, without asking Lavalink """
+    if not song.track:
+        return None
+
+    try:
+        decoded = lavalink.decode_track(song.track)
+    except (ValueError, IndexError, struct.error):
+        logger.warning('Stored track for punishment song %d is not decodable', song.id)
+        return None
+
+    return lavalink.AudioTrack({'encoded': song.track, 'info': decoded.raw['info']}, 0, punishment_song=song.id)
+
+
+async def get_song_track(song: PunishmentSong) -> Optional[lavalink.AudioTrack]:
+    """ Gets the track to play for a punishment song, only resolving the URL if we have nothing stored """
+    revalidating = song.id in plugin.bot.d.punishment_revalidating
+    if not revalidating:
+        if (track := decode_song_track(song)) is not None:
+            return track
+
+    result = await plugin.bot.track_search.get_tracks(song.url)
+    if not result or not result.tracks:
+        return None
+
+    track = result.tracks[0]
+    track.extra['punishment_song'] = song.id
+
+    # Store the track so we don't have to resolve it again next time, a revalidation stores its own
+    if track.track != song.track and not revalidating:
+        try:
+            await store_song_track(song.guild.id, song.id, track.track)
+        except Exception:
+            logger.exception('Failed to store the track for punishment song %d', song.id)
+
+    return track
+
+
+async def store_song_track(guild_id: int, song_id: int, track: str) -> None:
+    await PunishmentSong.objects.filter(id=song_id).update(track=track)
+    plugin.bot.d.punishment_settings.invalidate(guild_id)
+
+
+def revalidate_song(guild_id: int, song_id: int, url: str) -> None:
+    """ Re-resolves the stored track for a punishment song in the background """
+    revalidating: Dict[int, asyncio.Task] = plugin.bot.d.punishment_revalidating
+    if song_id in revalidating:
+        return
+
+    # The cached result may be the one that just failed, so make sure this, and anything playing the song meanwhile, gets a fresh one
+    plugin.bot.track_search.invalidate(url)
+
+    async def revalidate():
+        try:
+            result = await plugin.bot.track_search.get_tracks(url)
+            if not result or not result.tracks:
+                logger.warning('Could not revalidate punishment song %d, no results for %s', song_id, url)
+                return
+
+            await store_song_track(guild_id, song_id, result.tracks[0].track)
+            logger.info('Revalidated stored track for punishment song %d', song_id)
+        except Exception:
+            logger.exception('Failed to revalidate punishment song %d', song_id)
+        finally:
+            revalidating.pop(song_id, None)
+
+    revalidating[song_id] = asyncio.create_task(revalidate())
+
+
+async def play_punishment_song(player: lavalink.DefaultPlayer, songs: List[PunishmentSong]) -> None:
+    """ Starts playing a random punishment song """
+    track = await get_song_track(random.choice(songs))
+    if track is None:
+        return
+
+    # With only one song to choose from let the player repeat it, otherwise track_end_event picks the next one
+    player.set_loop(player.LOOP_SINGLE if len(songs) == 1 else player.LOOP_NONE)
+    await player.play(track)
 
 
 @plugin.command
@@ -32,6 +260,7 @@ async def set_channel(ctx: lightbulb.context.SlashContext, channel: hikari.Inter
 
     config.channel = channel.id
     await config.upsert()
+    ctx.bot.d.punishment_settings.invalidate(ctx.guild_id)
 
     await ctx.respond(
         hikari.Embed(
@@ -46,17 +275,16 @@ async def set_channel(ctx: lightbulb.context.SlashContext, channel: hikari.Inter
 @lightbulb.command("show", "Shows information about punishments", pass_options=True, ephemeral=True)
 @lightbulb.implements(lightbulb.commands.SlashSubCommand)
 async def show(ctx: lightbulb.context.SlashContext):
-    config = await PunishmentConfig.objects.get_or_none(guild=ctx.guild_id)
-    songs = PunishmentSong.objects.filter(guild=ctx.guild_id)
-    punishments: Dict[int, Dict[int, int]] = ctx.bot.d.punishments.get(ctx.guild_id, {})
+    settings = await get_settings(ctx.guild_id)
+    punishments = ctx.bot.d.punishments.get(ctx.guild_id)
 
-    if config is None or config.channel is None:
+    if settings.channel is None:
         channel = "Not Configured"
     else:
-        channel = f"<#{config.channel}>"
+        channel = f"<#{settings.channel}>"
 
     song_list = []
-    async for song in songs.iterate():
+    for song in settings.songs:
         song_list.append(f"🔹[{song.name}]({song.url})")
 
     if not song_list:
@@ -101,19 +329,21 @@ async def add_song(ctx: lightbulb.context.SlashContext, name: str, url: str):
         )
         return
 
-    result = await lavalink.auto_search_tracks(url)
+    result = await ctx.bot.track_search.get_tracks(url)
 
-    if not result:
+    if not result or not result.tracks:
         await ctx.respond(
            embed=hikari.Embed(
                 description="No results found for your query",
                 color=hikari.Colour(0xd32f2f)
             )
         )
+        return
 
-    result = result[0]
+    result = result.tracks[0]
 
-    await PunishmentSong.objects.create(guild=ctx.guild_id, name=name.lower(), url=result.uri)
+    await PunishmentSong.objects.create(guild=ctx.guild_id, name=name.lower(), url=result.uri, track=result.track)
+    ctx.bot.d.punishment_settings.invalidate(ctx.guild_id)
 
     await ctx.respond(
         hikari.Embed(
@@ -142,6 +372,7 @@ async def remove_song(ctx: lightbulb.context.SlashContext, name: str):
         return
 
     await song.delete()
+    ctx.bot.d.punishment_settings.invalidate(ctx.guild_id)
 
     await ctx.respond(
         hikari.Embed(
@@ -158,8 +389,8 @@ async def remove_song(ctx: lightbulb.context.SlashContext, name: str):
 @lightbulb.command("user", "Adds a punishment for the specified user", pass_options=True, ephemeral=True)
 @lightbulb.implements(lightbulb.commands.SlashSubCommand)
 async def punish_user(ctx: lightbulb.context.SlashContext, user: hikari.InteractionMember, seconds: int):
-    config = await PunishmentConfig.objects.get_or_none(guild=ctx.guild_id)
-    if config is None or config.channel is None:
+    settings = await get_settings(ctx.guild_id)
+    if settings.channel is None:
         await ctx.respond(
            embed=hikari.Embed(
                 description="Punishment channel config is not set!",
@@ -168,12 +399,7 @@ async def punish_user(ctx: lightbulb.context.SlashContext, user: hikari.Interact
         )
         return
 
-    if ctx.guild_id not in ctx.bot.d.punishments:
-        ctx.bot.d.punishments[ctx.guild_id] = {}
-
-    ctx.bot.d.punishments[ctx.guild_id][user.id] = int(time.time()) + seconds
-
-    # Set a task to remove punishment?
+    await ctx.bot.d.punishments.add(ctx.guild_id, user.id, int(time.time()) + seconds)
 
     await ctx.respond(
         hikari.Embed(
@@ -187,7 +413,9 @@ async def punish_user(ctx: lightbulb.context.SlashContext, user: hikari.Interact
         return
 
     try:
-        await ctx.bot.rest.edit_member(ctx.guild_id, user.id, voice_channel=config.channel)
+        await ctx.bot.rest_scheduler.run(
+            RESTPriority.HIGH, lambda: ctx.bot.rest.edit_member(ctx.guild_id, user.id, voice_channel=settings.channel)
+        )
     except hikari.ForbiddenError:
         pass
 
@@ -199,7 +427,7 @@ async def punish_user(ctx: lightbulb.context.SlashContext, user: hikari.Interact
 @lightbulb.implements(lightbulb.commands.SlashSubCommand)
 async def clear_punishment(ctx: lightbulb.context.SlashContext, user: Optional[hikari.InteractionChannel] = None):
     if user is None:
-        ctx.bot.d.punishments[ctx.guild_id] = {}
+        await ctx.bot.d.punishments.clear(ctx.guild_id)
 
         await ctx.respond(
             hikari.Embed(
@@ -209,7 +437,7 @@ async def clear_punishment(ctx: lightbulb.context.SlashContext, user: Optional[h
         )
         return
 
-    if user.id not in ctx.bot.d.punishments[ctx.guild_id]:
+    if not ctx.bot.d.punishments.is_punished(ctx.guild_id, user.id):
         await ctx.respond(
            embed=hikari.Embed(
                 description=f"User <@{user.id}> is not currently punished.",
@@ -218,7 +446,7 @@ async def clear_punishment(ctx: lightbulb.context.SlashContext, user: Optional[h
         )
         return
 
-    del ctx.bot.d.punishments[ctx.guild_id][user.id]
+    await ctx.bot.d.punishments.remove(ctx.guild_id, user.id)
 
     await ctx.respond(
             hikari.Embed(
@@ -234,97 +462,112 @@ async def voice_server_update(event: hikari.VoiceStateUpdateEvent):
     if event.state.user_id == plugin.bot.get_me().id:
         return
 
-    config = await PunishmentConfig.objects.get_or_none(guild=event.guild_id)
+    settings = await get_settings(event.guild_id)
     # IF punishment hasn't been setup
-    if config is None or config.channel is None:
+    if settings.channel is None:
         return
 
     voice: LavalinkVoice = plugin.bot.voice.connections.get(event.guild_id)
-    punishments = plugin.bot.d.punishments.get(event.guild_id, {})
+    punishments: PunishmentStore = plugin.bot.d.punishments
 
     # User Entering the punishment channel
-    if event.state.channel_id == config.channel:
+    if event.state.channel_id == settings.channel:
         # If sunbot is already busy, we can't do anything
         if voice:
             return
 
-        songs = await PunishmentSong.objects.filter(guild=event.guild_id).all()
-        if not songs:
+        if not settings.songs:
             return
 
         voice = await LavalinkVoice.connect(
             event.guild_id,
-            config.channel,
+            settings.channel,
             plugin.bot,
             plugin.bot.lavalink,
-            (config.channel, plugin.bot.rest),
+            (settings.channel, plugin.bot.rest),
         )
 
-        song: PunishmentSong = random.choice(songs)
-        player = voice.player
-
-        result = await player.node.get_tracks(song.url)
-        await player.play(result.tracks[0])
+        await play_punishment_song(voice.player, settings.songs)
 
     # User been punished entering a non-punishment channel
-    elif event.state.user_id in punishments:
-
-        # Check if their punishment is over
-        until = punishments[event.state.user_id]
-        if until - int(time.time()) <= 0:
-            del plugin.bot.d.punishments[event.guild_id][event.state.user_id]
-            return
-
+    elif punishments.is_punished(event.guild_id, event.state.user_id):
         try:
-            await plugin.bot.rest.edit_member(event.guild_id, event.state.user_id, voice_channel=config.channel)
+            await plugin.bot.rest_scheduler.run(
+                RESTPriority.HIGH,
+                lambda: plugin.bot.rest.edit_member(event.guild_id, event.state.user_id, voice_channel=settings.channel)
+            )
         except hikari.ForbiddenError:
             pass
     # User leaving the punishment channel
-    elif event.old_state is not None and event.old_state.channel_id == config.channel:
-        if voice and voice.channel_id == config.channel:
-            if len(plugin.bot.cache.get_voice_states_view_for_channel(event.guild_id, config.channel)) == 1:
+    elif event.old_state is not None and event.old_state.channel_id == settings.channel:
+        if voice and voice.channel_id == settings.channel:
+            if len(plugin.bot.cache.get_voice_states_view_for_channel(event.guild_id, settings.channel)) == 1:
                 await voice.disconnect()
 
 
 async def track_end_event(event: lavalink.TrackEndEvent):
 
-    player = event.player
+    player: lavalink.DefaultPlayer = event.player
 
     # If we are not in a voice channel
     if not player:
         return
 
+    # The track was stopped or replaced, or the player is already repeating it
+    if not event.reason.may_start_next() or player.loop == player.LOOP_SINGLE:
+        return
+
     # IF punishment hasn't been setup
-    config = await PunishmentConfig.objects.get_or_none(guild=player.guild_id)
-    if config is None or config.channel is None:
+    settings = await get_settings(player.guild_id)
+    if settings.channel is None:
         return
 
     # Or we are not in the punishment channel
-    if player.channel_id != config.channel:
+    if player.channel_id != settings.channel:
         return
 
     # Or if we have no songs to play
-    songs = await PunishmentSong.objects.filter(guild=player.guild_id).all()
-    if not songs:
+    if not settings.songs:
         return
 
-    song: PunishmentSong = random.choice(songs)
-    result = await player.node.get_tracks(song.url)
-    await player.play(result.tracks[0])
+    # Queue the next song rather than playing it, the player starts it once it handles this event
+    track = await get_song_track(random.choice(settings.songs))
+    if track is not None:
+        player.add(track)
+
+
+async def track_exception_event(event: lavalink.TrackExceptionEvent):
+
+    if event.track is None or 'punishment_song' not in event.track.extra:
+        return
+
+    # Stop repeating a track that cannot be played, and get a fresh copy of it for next time
+    event.player.set_loop(event.player.LOOP_NONE)
+
+    song_id = event.track.extra['punishment_song']
+    logger.warning('Punishment song %d failed to play, revalidating: %s', song_id, event.message)
+    revalidate_song(event.player.guild_id, song_id, event.track.uri)
 
 
 def load(bot: lightbulb.BotApp) -> None:
 
-    if lavalink is None:
+    if bot.lavalink is None:
         logger.warning('Not loading Punishment plugin as lavalink is not setup')
         return
 
     bot.add_plugin(plugin)
     bot.lavalink.add_event_hook(track_end_event, event=lavalink.TrackEndEvent)
+    bot.lavalink.add_event_hook(track_exception_event, event=lavalink.TrackExceptionEvent)
 
-    # Setup temp storage of punishments
-    bot.d.punishments: Dict[int, Dict[int, int]] = {}
+    # Load punishments from the database, they are expired by the store's scheduler
+    bot.d.punishments = PunishmentStore()
+    bot.d.punishments.start()
+    bot.d.punishment_settings = TTLCache(maxsize=SETTINGS_CACHE_SIZE, ttl=SETTINGS_CACHE_TTL)
+    bot.d.punishment_revalidating: Dict[int, asyncio.Task] = {}
+    bot.metrics.add_collector("punishment_settings", lambda: flatten_stats("punishment_settings_cache", bot.d.punishment_settings.stats()))
 
 
 def unload(bot: lightbulb.BotApp) -> None:
+    bot.d.punishments.stop()
+    bot.metrics.remove_collector("punishment_settings")
     bot.remove_plugin(plugin)
@@ -2,11 +2,12 @@ import lightbulb
 import hikari
 from time import time
 from datetime import timedelta
-from psutil import Process
 from hikari import __version__ as hikari_version
 from lightbulb import __version__ as lightbulb_version
 from platform import python_version
 from sunbot import __version__
+from sunbot.lavalink.telemetry import PlaybackTelemetry
+from sunbot.utils.series import TimeSeries
 
 
 plugin = lightbulb.Plugin("Info")
@@ -23,6 +24,9 @@ async def sunbot_group(ctx: lightbulb.context.SlashContext):
 @lightbulb.command("info", "Displays information about the bot")
 @lightbulb.implements(lightbulb.commands.SlashSubCommand)
 async def info(ctx: lightbulb.context.SlashContext) -> None:
+    # Only imported when needed, it is slow to import
+    from psutil import Process
+
     proc = Process()
     with proc.oneshot():
         uptime = timedelta(seconds=time() - proc.create_time())
@@ -58,6 +62,131 @@ async def list_plugins(ctx: lightbulb.context.SlashContext) -> None:
     await ctx.respond(embed)
 
 
+@sunbot_group.child
+@lightbulb.command("caches", "Shows how well the shared caches are doing")
+@lightbulb.implements(lightbulb.commands.SlashSubCommand)
+async def list_caches(ctx: lightbulb.context.SlashContext) -> None:
+    embed = hikari.Embed(
+        title="Cache Statistics",
+        color=hikari.Colour(0xF1C40F)
+    )
+
+    caches = {
+        "Track Search": ctx.bot.track_search,
+        "Punishment Settings": ctx.bot.d.get("punishment_settings"),
+    }
+    for name, cache in caches.items():
+        if cache is None:
+            continue
+        stats = cache.stats()
+        embed.add_field(name, f"Hit rate: `{stats['hit_rate']:.0%}` | Hits: `{stats['hits']}` | Size: `{stats['size']}`")
+
+    if not embed.fields:
+        embed.description = "No caches are in use"
+    await ctx.respond(embed)
+
+
+@sunbot_group.child
+@lightbulb.add_checks(lightbulb.owner_only)
+@lightbulb.command("nodes", "Shows the load on each Lavalink node and recent placement decisions")
+@lightbulb.implements(lightbulb.commands.SlashSubCommand)
+async def list_nodes(ctx: lightbulb.context.SlashContext) -> None:
+    embed = hikari.Embed(
+        title="Lavalink Nodes",
+        color=hikari.Colour(0xF1C40F)
+    )
+
+    if ctx.bot.lavalink is None:
+        embed.description = "Lavalink is not configured"
+        await ctx.respond(embed)
+        return
+
+    from sunbot.lavalink.nodes import node_load
+
+    for node in ctx.bot.lavalink.node_manager.nodes:
+        stats = node.stats
+        status = "Available" if node.available else "Unavailable"
+        embed.add_field(
+            f"{node.name} ({node.region or 'no region'}) - {status}",
+            f"Players: `{len(node.players)}` | Playing: `{stats.playing_players}` | Load: `{node_load(node):.0f}`\n"
+            f"CPU: `{stats.system_load:.0%}` system, `{stats.lavalink_load:.0%}` lavalink\n"
+            f"Frames: `{stats.frames_sent}` sent, `{stats.frames_nulled}` nulled, `{stats.frames_deficit}` deficit"
+        )
+
+    decisions = getattr(ctx.bot.lavalink.node_manager, "decisions", None)
+    if decisions:
+        recent = [
+            f"<t:{int(decision.time)}:R> {decision.region or 'any'} -> `{decision.node or 'none'}`"
+            for decision in list(decisions)[-5:]
+        ]
+        embed.add_field("Recent Decisions", "\n".join(reversed(recent)))
+
+    if not embed.fields:
+        embed.description = "No nodes have been added"
+    await ctx.respond(embed)
+
+
+def format_series(series: TimeSeries, unit: str = "", scale: float = 1) -> str:
+    summary = series.summary()
+    if not summary["count"]:
+        return "`no data`"
+    return f"p95 `{summary['p95'] * scale:.0f}{unit}` | max `{summary['max'] * scale:.0f}{unit}` | samples `{summary['count']}`"
+
+
+@sunbot_group.child
+@lightbulb.add_checks(lightbulb.owner_only)
+@lightbulb.option("guild", "Show the player health of a single guild", type=str, required=False, default=None)
+@lightbulb.command("playback", "Shows playback telemetry from Lavalink", pass_options=True)
+@lightbulb.implements(lightbulb.commands.SlashSubCommand)
+async def playback_telemetry(ctx: lightbulb.context.SlashContext, guild: str) -> None:
+    embed = hikari.Embed(
+        title="Playback Telemetry",
+        color=hikari.Colour(0xF1C40F)
+    )
+
+    telemetry: PlaybackTelemetry = ctx.bot.playback
+    if telemetry is None:
+        embed.description = "Lavalink is not configured"
+        await ctx.respond(embed)
+        return
+
+    if guild is not None:
+        health = telemetry.guilds.get(int(guild)) if guild.isdigit() else None
+        if health is None:
+            embed.description = "Nothing has been recorded for that guild"
+        else:
+            embed.add_field("Ping", format_series(health.ping, "ms"))
+            embed.add_field(
+                "Events",
+                f"Disconnects: `{health.disconnects}` | Voice closes: `{health.voice_closes}` | "
+                f"Exceptions: `{health.exceptions}` | Stuck: `{health.stuck}`"
+            )
+        await ctx.respond(embed)
+        return
+
+    for node, series in telemetry.nodes.items():
+        lines = [
+            f"{name.replace('_', ' ').capitalize()}: {format_series(values, scale=100 if name.endswith('load') else 1)}"
+            for name, values in series.items()
+        ]
+        embed.add_field(f"Node {node}", "\n".join(lines))
+
+    embed.add_field("Track Loads", format_series(telemetry.track_loads, "ms", 1000))
+    embed.add_field("Track Start Gaps", format_series(telemetry.start_gaps, "ms", 1000))
+
+    exceptions = ", ".join(f"{severity}: `{count}`" for severity, count in telemetry.exceptions.most_common())
+    embed.add_field("Track Exceptions", exceptions or "`none`")
+
+    # The guilds with the worst voice connections are the most likely to be stuttering
+    worst = sorted(telemetry.guilds.items(), key=lambda item: item[1].disconnects + item[1].voice_closes, reverse=True)[:5]
+    worst = [f"`{guild_id}` disconnects `{health.disconnects}`, voice closes `{health.voice_closes}`"
+             for guild_id, health in worst if health.disconnects or health.voice_closes]
+    if worst:
+        embed.add_field("Unstable Guilds", "\n".join(worst))
+
+    await ctx.respond(embed)
+
+
 def load(bot: lightbulb.BotApp) -> None:
     bot.add_plugin(plugin)
 
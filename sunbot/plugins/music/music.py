@@ -1,10 +1,13 @@
 import lightbulb
 import hikari
+import asyncio
 import logging
 import re
 import lavalink
 from datetime import timedelta
-from lightbulb.ext import tasks
+from typing import Dict, List, Optional
+from sunbot.config import CONFIG
+from sunbot.lavalink.snapshots import QueueSnapshots
 from sunbot.lavalink.voice import LavalinkVoice
 from sunbot.lavalink.utils import join_voice, check_in_voice, check_music_queued
 
@@ -12,6 +15,11 @@ from sunbot.lavalink.utils import join_voice, check_in_voice, check_music_queued
 logger = logging.getLogger(__name__)
 plugin = lightbulb.Plugin("Music")
 
+# The number of playlist tracks to add to the queue before letting other tasks run
+ENQUEUE_BATCH_SIZE = 50
+# How long to wait for a Lavalink node when restoring queues at startup
+RESTORE_NODE_TIMEOUT = 30
+
 
 @plugin.command()
 @lightbulb.option(name="query", description="query to search", required=True)
@@ -23,9 +31,6 @@ async def play_command(ctx: lightbulb.context.Context, query: str):
     if not await join_voice(ctx):
         return
 
-    voice: LavalinkVoice = ctx.bot.voice.connections.get(ctx.guild_id)
-    player = voice.player
-
     # Remove leading and trailing <>. <> may be used to suppress embedding links in Discord.
     query = query.strip('<>')
 
@@ -34,8 +39,8 @@ async def play_command(ctx: lightbulb.context.Context, query: str):
     if not url_rx.match(query):
         query = f'ytsearch:{query}'
 
-    # Get the results for the query from Lavalink.
-    results = await player.node.get_tracks(query)
+    # Get the results for the query from Lavalink, popular songs are often already cached
+    results = await ctx.bot.track_search.get_tracks(query)
 
     if not results or not results.tracks:
         await ctx.respond(
@@ -46,25 +51,52 @@ async def play_command(ctx: lightbulb.context.Context, query: str):
         )
         return
 
+    # Anything already being added from a playlist goes first, so this ends up after it. wait doesn't raise
+    # if that is cancelled by /stop, /clear or leaving the channel, which just means there is nothing left to wait for
+    if (pending := ctx.bot.d.music_enqueue.get(ctx.guild_id)) is not None:
+        await asyncio.wait({pending})
+
+    # The search and the wait give /stop, /clear or an idle disconnect time to tear down the player
+    voice: Optional[LavalinkVoice] = ctx.bot.voice.connections.get(ctx.guild_id)
+    if voice is None:
+        await ctx.respond(
+           embed=hikari.Embed(
+                description="I'm no longer connected to a voice channel",
+                color=hikari.Colour(0xd32f2f)
+            )
+        )
+        return
+    player = voice.player
+
+    space = CONFIG.lavalink.max_queue_size - len(player.queue)
+    if space <= 0:
+        await ctx.respond(
+           embed=hikari.Embed(
+                description=f"The queue is full, it can only hold {CONFIG.lavalink.max_queue_size} songs",
+                color=hikari.Colour(0xd32f2f)
+            )
+        )
+        return
+
     description: str
     action: str
     position: int = len(player.queue)
 
     if results.load_type == lavalink.LoadType.PLAYLIST:
-        track_details = []
-        total_duration = 0
-        for track in results.tracks:
-            player.add(requester=ctx.author.id, track=track)
-            track_details.append(f"🔹[{track.title}]({track.uri})")
-            total_duration += track.duration
+        tracks = results.tracks[:space]
+        player.add(requester=ctx.author.id, track=tracks[0])
+        if len(tracks) > 1:
+            enqueue_in_background(ctx.guild_id, player, tracks[1:], ctx.author.id)
 
         action = 'Added Playlist to Queue'
-        duration = timedelta(milliseconds=total_duration)
-
-        description = f"{'\n'.join(track_details[:10])}\n"
-        if len(track_details) > 10:
-            description += f'+ {len(track_details) - 10} more\n'
-        description += f"Position: `{position}-{position + len(results.tracks)}` | Duration: `{str(duration)}`"
+        duration = timedelta(milliseconds=sum(track.duration for track in tracks))
+
+        description = "".join(f"🔹[{track.title}]({track.uri})\n" for track in tracks[:10])
+        if len(tracks) > 10:
+            description += f'+ {len(tracks) - 10} more\n'
+        if len(tracks) < len(results.tracks):
+            description += f'{len(results.tracks) - len(tracks)} songs skipped as the queue is full\n'
+        description += f"Position: `{position}-{position + len(tracks)}` | Duration: `{str(duration)}`"
     else:
         track = results.tracks[0]
         player.add(requester=ctx.author.id, track=track)
@@ -84,6 +116,36 @@ async def play_command(ctx: lightbulb.context.Context, query: str):
     ).set_author(name=action, icon=ctx.author.avatar_url))
 
 
+def enqueue_in_background(guild_id: int, player: lavalink.DefaultPlayer, tracks: List[lavalink.AudioTrack], requester: int):
+    """ Adds the rest of a playlist to the queue without holding up the command """
+    enqueuing: Dict[int, asyncio.Task] = plugin.bot.d.music_enqueue
+
+    async def enqueue():
+        try:
+            for start in range(0, len(tracks), ENQUEUE_BATCH_SIZE):
+                # Stop if we have left the channel, or the queue has filled up in the meantime
+                if plugin.bot.voice.connections.get(guild_id) is None:
+                    return
+
+                for track in tracks[start:start + ENQUEUE_BATCH_SIZE]:
+                    if len(player.queue) >= CONFIG.lavalink.max_queue_size:
+                        return
+                    player.add(requester=requester, track=track)
+
+                await asyncio.sleep(0)
+        finally:
+            # A newer playlist may have been registered for the guild after this one was cancelled
+            if enqueuing.get(guild_id) is asyncio.current_task():
+                del enqueuing[guild_id]
+
+    enqueuing[guild_id] = asyncio.create_task(enqueue())
+
+
+def cancel_enqueue(guild_id: int):
+    if (task := plugin.bot.d.music_enqueue.pop(guild_id, None)) is not None:
+        task.cancel()
+
+
 @plugin.command()
 @lightbulb.add_checks(check_in_voice, check_music_queued)
 @lightbulb.command(name="pause", description="Pauses playing music")
@@ -213,6 +275,7 @@ async def nowplaying_command(ctx: lightbulb.context.Context):
 @lightbulb.implements(lightbulb.commands.SlashCommand)
 async def clear_command(ctx: lightbulb.context.Context):
     voice: LavalinkVoice = ctx.bot.voice.connections.get(ctx.guild_id)
+    cancel_enqueue(ctx.guild_id)
     voice.player.queue.clear()
     await ctx.respond(hikari.Embed(
         color=hikari.Colour(0x2ECC71)
@@ -225,24 +288,127 @@ async def clear_command(ctx: lightbulb.context.Context):
 @lightbulb.implements(lightbulb.commands.SlashCommand)
 async def stop_command(ctx: lightbulb.context.Context):
     voice: LavalinkVoice = ctx.bot.voice.connections.get(ctx.guild_id)
+    cancel_enqueue(ctx.guild_id)
     await voice.disconnect()
     await ctx.respond(hikari.Embed(
         color=hikari.Colour(0x2ECC71)
     ).set_author(name="Stopped playing music", icon=ctx.author.avatar_url))
 
 
-@tasks.task(s=60, auto_start=True)
-async def disconnect_if_empty():
-    """ Leave the voice channel if there are no other users in the channel """
+def count_listeners(guild_id: int, channel_id: int) -> int:
+    """ The number of people, not bots, in a voice channel """
+    states = plugin.bot.cache.get_voice_states_view_for_channel(guild_id, channel_id)
+    return sum(1 for state in states.values() if state.member and not state.member.is_bot)
 
-    for _, player in plugin.bot.lavalink.players.items():
-        voice = plugin.bot.voice.connections.get(player.guild_id)
-        if not voice:
-            continue
-        voice_states = plugin.bot.cache.get_voice_states_view_for_channel(player.guild_id, voice.channel_id)
-        if len(voice_states) == 1:
-            logger.info(f'Leaving voice channel {voice.channel_id} in guild {player.guild_id} as it is empty')
+
+def cancel_idle_disconnect(guild_id: int):
+    if (task := plugin.bot.d.music_idle.pop(guild_id, None)) is not None:
+        task.cancel()
+
+
+def schedule_idle_disconnect(guild_id: int):
+    """ Leaves the voice channel once it has been empty for the idle timeout """
+    idle: Dict[int, asyncio.Task] = plugin.bot.d.music_idle
+    if guild_id in idle:
+        return
+
+    async def disconnect():
+        await asyncio.sleep(CONFIG.lavalink.idle_timeout)
+        idle.pop(guild_id, None)
+
+        # Someone may have come back without it being noticed, i.e. across a reconnect
+        voice: LavalinkVoice = plugin.bot.voice.connections.get(guild_id)
+        if voice is None or count_listeners(guild_id, voice.channel_id):
+            return
+
+        logger.info(f'Leaving voice channel {voice.channel_id} in guild {guild_id} as it is empty')
+        cancel_enqueue(guild_id)
+        await voice.disconnect()
+
+    idle[guild_id] = asyncio.create_task(disconnect())
+
+
+@plugin.listener(hikari.VoiceStateUpdateEvent)
+async def on_voice_state_update(event: hikari.VoiceStateUpdateEvent):
+    voice: LavalinkVoice = plugin.bot.voice.connections.get(event.guild_id)
+    if voice is None:
+        return
+
+    # We were disconnected by someone else, clean up rather than holding on to the player
+    if event.state.user_id == plugin.bot.get_me().id:
+        if event.state.channel_id is None:
+            cancel_idle_disconnect(event.guild_id)
+            cancel_enqueue(event.guild_id)
             await voice.disconnect()
+        return
+
+    # Only joins and leaves of our channel can change whether it is empty
+    channels = {event.state.channel_id, event.old_state.channel_id if event.old_state else None}
+    if voice.channel_id not in channels:
+        return
+
+    if count_listeners(event.guild_id, voice.channel_id):
+        cancel_idle_disconnect(event.guild_id)
+    else:
+        schedule_idle_disconnect(event.guild_id)
+
+
+async def resume_queue(guild_id: int):
+    """ Rejoins the voice channel a guild was listening in before a restart and carries on with its queue """
+    snapshots: QueueSnapshots = plugin.bot.d.music_snapshots
+    if guild_id not in snapshots.pending:
+        return
+    snapshots.pending.discard(guild_id)
+
+    try:
+        snapshot = await snapshots.get(guild_id)
+        if snapshot is None:
+            return
+
+        # Only come back if someone is still there to listen, and we haven't been asked to play something else already
+        states = plugin.bot.cache.get_voice_states_view_for_channel(guild_id, snapshot.channel)
+        listeners = [state for state in states.values() if state.member and not state.member.is_bot]
+        if not listeners or plugin.bot.voice.connections.get(guild_id):
+            await snapshots.delete(guild_id)
+            return
+
+        for _ in range(RESTORE_NODE_TIMEOUT):
+            if plugin.bot.lavalink.node_manager.available_nodes:
+                break
+            await asyncio.sleep(1)
+
+        voice = await LavalinkVoice.connect(
+            guild_id,
+            snapshot.channel,
+            plugin.bot,
+            plugin.bot.lavalink,
+            (snapshot.channel, plugin.bot.rest),
+        )
+        await snapshots.restore(voice.player, snapshot)
+    except Exception:
+        logger.exception('Failed to restore the queue for guild %d', guild_id)
+
+
+async def resume_queues():
+    snapshots: QueueSnapshots = plugin.bot.d.music_snapshots
+    await snapshots.load()
+
+    # Guilds that become available later are resumed by on_guild_available
+    for guild_id in list(snapshots.pending):
+        if plugin.bot.cache.get_available_guild(guild_id) is not None:
+            await resume_queue(guild_id)
+
+
+@plugin.listener(hikari.GuildAvailableEvent)
+async def on_guild_available(event: hikari.GuildAvailableEvent):
+    await resume_queue(event.guild_id)
+
+
+@plugin.listener(hikari.StoppingEvent)
+async def on_stopping(event: hikari.StoppingEvent):
+    # Save before the voice connections are closed, as that clears the queues. The database is only
+    # disconnected once the bot has stopped, so this finishes first
+    await plugin.bot.d.music_snapshots.stop()
 
 
 def load(bot: lightbulb.BotApp) -> None:
@@ -251,7 +417,20 @@ def load(bot: lightbulb.BotApp) -> None:
         return
 
     bot.add_plugin(plugin)
+    bot.d.music_enqueue: Dict[int, asyncio.Task] = {}
+    bot.d.music_idle: Dict[int, asyncio.Task] = {}
+    bot.d.music_snapshots = QueueSnapshots(bot.lavalink, CONFIG.lavalink.snapshot_interval)
+    bot.d.music_snapshots.start()
+    bot.d.music_resume = asyncio.create_task(resume_queues())
 
 
 def unload(bot: lightbulb.BotApp) -> None:
+    for task in bot.d.get("music_enqueue", {}).values():
+        task.cancel()
+    for task in bot.d.get("music_idle", {}).values():
+        task.cancel()
+    if "music_snapshots" in bot.d:
+        bot.d.music_resume.cancel()
+        # Kept so the final save isn't garbage collected before it finishes
+        bot.d.music_snapshots_stop = asyncio.create_task(bot.d.music_snapshots.stop())
     bot.remove_plugin(plugin)
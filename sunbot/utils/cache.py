@@ -0,0 +1,118 @@
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+_MISSING = object()
+
+
+class TTLCache(Generic[K, V]):
+    """ A small in-process cache with LRU eviction where entries also expire after a fixed time
+        Attributes:
+            maxsize (int): The maximum number of entries to hold before evicting the least recently used
+            ttl (float): Time in seconds an entry stays valid for
+            hits (int): The number of lookups that were served from the cache
+            misses (int): The number of lookups that were missing or had expired
+            evictions (int): The number of entries dropped to stay under maxsize
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        # Bumped on every invalidation so loads that raced with a write are not stored, only kept
+        # for keys with a load in flight so they don't grow past maxsize
+        self._versions: Dict[K, int] = {}
+        self._loading: Dict[K, int] = {}
+        # Bumped by clear, so loads started before it are not stored either
+        self._generation = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self._lookup(key) is not _MISSING
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _lookup(self, key: K) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISSING
+
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._data[key]
+            return _MISSING
+
+        self._data.move_to_end(key)
+        return value
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        """ Get a value from the cache, recording a hit or miss """
+        value = self._lookup(key)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None) -> None:
+        """ Store a value, evicting the least recently used entries if needed, ttl overrides the cache's for this entry """
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: K) -> None:
+        """ Drop a key from the cache, call this after writing the underlying data """
+        self._data.pop(key, None)
+        if key in self._loading:
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._generation += 1
+
+    async def get_or_load(self, key: K, loader: Callable[[], Awaitable[V]]) -> V:
+        """ Get a value from the cache, or await loader to fetch and store it """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        version = self._versions.get(key, 0)
+        generation = self._generation
+        self._loading[key] = self._loading.get(key, 0) + 1
+        try:
+            value = await loader()
+
+            # Only store the result if nothing invalidated the key while we were loading
+            if self._versions.get(key, 0) == version and self._generation == generation:
+                self.set(key, value)
+        finally:
+            self._loading[key] -= 1
+            if not self._loading[key]:
+                del self._loading[key]
+                self._versions.pop(key, None)
+        return value
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
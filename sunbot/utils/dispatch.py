@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import hikari
+
+from sunbot.utils.tracing import plugin_name, trace
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class MessageFacts:
+    """ Facts about a created message, worked out once and shared by every message handler
+        Attributes:
+            event (hikari.GuildMessageCreateEvent): The event the message came from
+            is_bot (bool): Whether the message was sent by a bot or webhook
+            content (str): The text content of the message, None if there is none
+            word_count (int): The number of words in the content
+            mentions_me (bool): Whether the message mentions the bot
+            is_reply (bool): Whether the message is a reply
+            reply_to_me (bool): Whether the message is a reply to one of the bot's messages
+    """
+    event: hikari.GuildMessageCreateEvent
+    is_bot: bool
+    content: Optional[str]
+    word_count: int
+    mentions_me: bool
+    is_reply: bool
+    reply_to_me: bool
+
+    @classmethod
+    def from_event(cls, event: hikari.GuildMessageCreateEvent, me_id: int) -> 'MessageFacts':
+        message = event.message
+        is_reply = message.type == hikari.MessageType.REPLY and message.referenced_message is not None
+        return cls(
+            event=event,
+            is_bot=event.is_bot,
+            content=message.content,
+            word_count=len(message.content.split()) if message.content else 0,
+            mentions_me=me_id in message.user_mentions_ids,
+            is_reply=is_reply,
+            reply_to_me=is_reply and message.referenced_message.author.id == me_id,
+        )
+
+    @property
+    def message(self) -> hikari.Message:
+        return self.event.message
+
+    @property
+    def guild_id(self) -> hikari.Snowflake:
+        return self.event.guild_id
+
+    @property
+    def channel_id(self) -> hikari.Snowflake:
+        return self.event.channel_id
+
+
+MessageHandler = Callable[[MessageFacts], Awaitable[None]]
+MessagePredicate = Callable[[MessageFacts], bool]
+
+
+@dataclass
+class _Registration:
+    name: str
+    handler: MessageHandler
+    predicate: Optional[MessagePredicate]
+    include_bots: bool
+    require_content: bool
+    calls: int = 0
+    errors: int = 0
+    total_time: float = 0
+    max_time: float = 0
+
+
+class MessageDispatcher:
+    """ Sends each created guild message to the handlers interested in it
+
+        The message is only inspected once, handlers declare what they are interested in and are only
+        called for messages that match. Matching handlers run concurrently, started in the order they
+        were registered.
+    """
+
+    def __init__(self) -> None:
+        self._handlers: List[_Registration] = []
+
+    def register(
+        self,
+        handler: MessageHandler,
+        predicate: Optional[MessagePredicate] = None,
+        include_bots: bool = False,
+        require_content: bool = True,
+    ) -> None:
+        """ Registers a handler to be called for messages
+
+            Args:
+                handler (MessageHandler): The coroutine function to call with the message facts
+                predicate (MessagePredicate): Only call the handler if this returns True
+                include_bots (bool): Whether to call the handler for messages sent by bots
+                require_content (bool): Whether to skip messages that have no text content
+        """
+        name = f"{handler.__module__}.{handler.__name__}"
+        self._handlers.append(_Registration(name, handler, predicate, include_bots, require_content))
+
+    def unregister(self, handler: MessageHandler) -> None:
+        self._handlers = [registration for registration in self._handlers if registration.handler is not handler]
+
+    def _matches(self, registration: _Registration, facts: MessageFacts) -> bool:
+        if facts.is_bot and not registration.include_bots:
+            return False
+        if facts.content is None and registration.require_content:
+            return False
+        return registration.predicate is None or registration.predicate(facts)
+
+    async def _run(self, registration: _Registration, facts: MessageFacts) -> None:
+        started = time.perf_counter()
+        try:
+            with trace("message.handler", registration.name, plugin_name(registration.handler.__module__)):
+                await registration.handler(facts)
+        except Exception:
+            registration.errors += 1
+            logger.exception('Message handler %s failed', registration.name)
+        finally:
+            elapsed = time.perf_counter() - started
+            registration.calls += 1
+            registration.total_time += elapsed
+            registration.max_time = max(registration.max_time, elapsed)
+
+    async def dispatch(self, event: hikari.GuildMessageCreateEvent, me_id: int) -> None:
+        facts = MessageFacts.from_event(event, me_id)
+        handlers = [registration for registration in self._handlers if self._matches(registration, facts)]
+        if handlers:
+            await asyncio.gather(*[self._run(registration, facts) for registration in handlers])
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            registration.name: {
+                "calls": registration.calls,
+                "errors": registration.errors,
+                "total_time": registration.total_time,
+                "avg_time": registration.total_time / registration.calls if registration.calls else 0.0,
+                "max_time": registration.max_time,
+            }
+            for registration in self._handlers
+        }
@@ -0,0 +1,83 @@
+import logging
+from dataclasses import dataclass
+from typing import Dict, Iterable, Type, TypeVar
+
+import hikari
+
+from sunbot.config import GatewayConfig
+
+logger = logging.getLogger(__name__)
+
+F = TypeVar("F", hikari.Intents, hikari.api.CacheComponents)
+
+
+@dataclass(frozen=True)
+class GatewayNeeds:
+    """ The gateway intents and cache components something needs to work
+        Attributes:
+            intents (hikari.Intents): The intents needed to receive its events
+            cache (hikari.api.CacheComponents): The cache components it reads from
+    """
+    intents: hikari.Intents = hikari.Intents.NONE
+    cache: hikari.api.CacheComponents = hikari.api.CacheComponents.NONE
+
+    def __or__(self, other: "GatewayNeeds") -> "GatewayNeeds":
+        return GatewayNeeds(self.intents | other.intents, self.cache | other.cache)
+
+
+# What the bot itself needs, guild available events and our own user
+BASE_NEEDS = GatewayNeeds(hikari.Intents.GUILDS, hikari.api.CacheComponents.GUILDS | hikari.api.CacheComponents.ME)
+
+MESSAGE_NEEDS = GatewayNeeds(hikari.Intents.GUILD_MESSAGES | hikari.Intents.MESSAGE_CONTENT)
+# Voice states cache the member they belong to, so the member cache isn't needed to see who is listening
+VOICE_NEEDS = GatewayNeeds(hikari.Intents.GUILD_VOICE_STATES, hikari.api.CacheComponents.VOICE_STATES)
+# Lightbulb's has_guild_permissions check works out permissions from the cached channels and roles
+PERMISSION_NEEDS = GatewayNeeds(cache=hikari.api.CacheComponents.GUILD_CHANNELS | hikari.api.CacheComponents.ROLES)
+
+# What each plugin needs on top of the base, plugins not listed need nothing more
+PLUGIN_NEEDS: Dict[str, GatewayNeeds] = {
+    "sunbot.plugins.fun.ai": MESSAGE_NEEDS,
+    "sunbot.plugins.fun.dad": MESSAGE_NEEDS,
+    "sunbot.plugins.fun.punishment": VOICE_NEEDS | PERMISSION_NEEDS,
+    "sunbot.plugins.music.music": VOICE_NEEDS,
+}
+
+
+def _parse_flags(flag_type: Type[F], names: Iterable[str]) -> F:
+    value = flag_type.NONE
+    for name in names:
+        try:
+            value |= flag_type[name.upper()]
+        except KeyError:
+            raise ValueError(f'Unknown {flag_type.__name__} name: {name}') from None
+    return value
+
+
+def resolve_gateway(config: GatewayConfig, plugins: Iterable[str]) -> GatewayNeeds:
+    """ The intents and cache components to use, anything not set in the config is derived from what the plugins need """
+    preset = BASE_NEEDS
+    for plugin in plugins:
+        preset |= PLUGIN_NEEDS.get(plugin, GatewayNeeds())
+
+    intents = preset.intents if config.intents is None else _parse_flags(hikari.Intents, config.intents)
+    cache = preset.cache if config.cache_components is None else _parse_flags(hikari.api.CacheComponents, config.cache_components)
+    return GatewayNeeds(intents, cache)
+
+
+def check_gateway(gateway: GatewayNeeds, plugins: Iterable[str]) -> None:
+    """ Warns about the bot, and each plugin, needing intents or cache components that aren't enabled """
+    needs = {"sunbot": BASE_NEEDS, **{plugin: PLUGIN_NEEDS[plugin] for plugin in plugins if plugin in PLUGIN_NEEDS}}
+    for name, need in needs.items():
+        if missing := need.intents & ~gateway.intents:
+            logger.warning('%s needs intents that are not enabled: %s', name, missing)
+        if missing := need.cache & ~gateway.cache:
+            logger.warning('%s needs cache components that are not enabled: %s', name, missing)
+
+
+def cache_settings(config: GatewayConfig, components: hikari.api.CacheComponents) -> hikari.impl.CacheSettings:
+    """ The cache settings to give hikari, with the message and DM channel limits from the config """
+    return hikari.impl.CacheSettings(
+        components=components,
+        max_messages=config.max_messages,
+        max_dm_channel_ids=config.max_dm_channel_ids,
+    )
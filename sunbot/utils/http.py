@@ -0,0 +1,34 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+import aiohttp
+
+from sunbot.config import HTTPConfig
+
+if TYPE_CHECKING:
+    import httpx
+
+
+def create_session(config: HTTPConfig) -> aiohttp.ClientSession:
+    """ Creates the aiohttp session shared by plugins, connections are pooled and kept alive between requests """
+    connector = aiohttp.TCPConnector(
+        limit=config.max_connections,
+        limit_per_host=config.max_connections_per_host,
+        keepalive_timeout=config.keepalive_timeout,
+        ttl_dns_cache=config.dns_cache_ttl,
+    )
+    timeout = aiohttp.ClientTimeout(total=config.timeout, connect=config.connect_timeout)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+def create_httpx_client(config: HTTPConfig) -> httpx.AsyncClient:
+    """ Creates the httpx client used by the OpenAI SDK, httpx has no per-host limit so only the overall limit applies """
+    import httpx
+
+    limits = httpx.Limits(
+        max_connections=config.max_connections,
+        max_keepalive_connections=config.max_connections,
+        keepalive_expiry=config.keepalive_timeout,
+    )
+    timeout = httpx.Timeout(config.timeout, connect=config.connect_timeout)
+    return httpx.AsyncClient(limits=limits, timeout=timeout)
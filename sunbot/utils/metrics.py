@@ -0,0 +1,263 @@
+import abc
+import bisect
+import functools
+import logging
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# A single value, as (name, labels, value)
+Metric = Tuple[str, Dict[str, str], float]
+LabelValues = Tuple[str, ...]
+
+# Latency buckets in seconds, from a quick listener up to a slow OpenAI request
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def flatten_stats(prefix: str, stats: Dict, label: str = None) -> List[Metric]:
+    """ Turns a stats() dict into metrics, a nested dict is labelled with its key i.e. {"high": {"shed": 1}} """
+    metrics: List[Metric] = []
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            metrics.extend((f"{prefix}_{name}", {label or "key": str(key)}, inner) for name, inner in value.items())
+        elif isinstance(value, (int, float)):
+            metrics.append((f"{prefix}_{key}", {}, value))
+    return metrics
+
+
+class _Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _labels(self, key: LabelValues, **extra: str) -> Dict[str, str]:
+        return {**dict(zip(self.labels, key)), **extra}
+
+    @abc.abstractmethod
+    def samples(self) -> Iterable[Metric]:
+        """ Each value of the metric, as (name, labels, value) """
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{_format_labels(labels)} {value}" for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(_Metric):
+    """ A value that only goes up, i.e. the number of errors """
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, description, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[Metric]:
+        return ((self.name, self._labels(key), value) for key, value in self.values.items())
+
+
+class Gauge(Counter):
+    """ A value that goes up and down, i.e. the number of commands running """
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """ Counts observations into buckets, i.e. how long commands take """
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> (count in each bucket, the last being +Inf, sum of observations)
+        self.values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        if key not in self.values:
+            self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = self.values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def samples(self) -> Iterable[Metric]:
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket", self._labels(key, le=le), cumulative
+            yield f"{self.name}_sum", self._labels(key), total[0]
+            yield f"{self.name}_count", self._labels(key), cumulative
+
+
+class MetricsRegistry:
+    """ Holds the bot's metrics and renders them in the Prometheus text format
+
+        Components that already keep their own stats are added as collectors rather than
+        having them write to metrics, a collector is called each time the metrics are scraped.
+
+        Attributes:
+            prefix (str): Prepended to the name of every metric
+    """
+
+    def __init__(self, prefix: str = "sunbot") -> None:
+        self.prefix = prefix
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: Dict[str, Callable[[], Iterable[Metric]]] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(f"{self.prefix}_{name}", description, labels))
+
+    def gauge(self, name: str, description: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(f"{self.prefix}_{name}", description, labels))
+
+    def histogram(self, name: str, description: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(f"{self.prefix}_{name}", description, labels, buckets))
+
+    def add_collector(self, name: str, collector: Callable[[], Iterable[Metric]]) -> None:
+        """ Adds (or replaces) a collector, the metrics it returns are prefixed and exported as gauges """
+        self._collectors[name] = collector
+
+    def remove_collector(self, name: str) -> None:
+        self._collectors.pop(name, None)
+
+    def collect(self) -> List[Metric]:
+        metrics: List[Metric] = []
+        for name, collector in list(self._collectors.items()):
+            try:
+                metrics.extend((f"{self.prefix}_{metric}", labels, value) for metric, labels, value in collector() if value is not None)
+            except Exception:
+                logger.exception('Metrics collector %s failed', name)
+        return metrics
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+
+        # Collected metrics are grouped by name so each only gets a single TYPE line
+        collected: Dict[str, List[Metric]] = {}
+        for metric in self.collect():
+            collected.setdefault(metric[0], []).append(metric)
+        for name, samples in collected.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(f"{name}{_format_labels(labels)} {value}" for _, labels, value in samples)
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """ Serves a registry on /metrics for Prometheus to scrape
+
+        Attributes:
+            registry (MetricsRegistry): The metrics to serve
+            host (str): The address to listen on
+            port (int): The port to listen on
+    """
+
+    def __init__(self, registry: MetricsRegistry, host: str, port: int) -> None:
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: Optional["web.AppRunner"] = None
+
+    async def start(self) -> None:
+        # The server is only imported when metrics are enabled
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info('Serving metrics on http://%s:%d/metrics', self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_metrics(self, request: "web.Request") -> "web.Response":
+        from aiohttp import web
+
+        started = time.perf_counter()
+        body = self.registry.render()
+        logger.debug('Rendered metrics in %.1fms', (time.perf_counter() - started) * 1000)
+        return web.Response(text=body, content_type="text/plain", charset="utf-8")
+
+
+class BotInstruments:
+    """ The metrics recorded for every command and listener the bot runs
+
+        Attributes:
+            command_duration (Histogram): Time taken to run each command
+            command_errors (Counter): Commands that failed, by command and exception class
+            commands_in_flight (Gauge): Commands currently running
+            listener_duration (Histogram): Time taken by each listener
+            listener_errors (Counter): Listeners that raised, by listener, event and exception class
+            listeners_in_flight (Gauge): Listeners currently running, by event
+    """
+
+    def __init__(self, registry: MetricsRegistry) -> None:
+        self.command_duration = registry.histogram("command_duration_seconds", "Time taken to run a command", ("command",))
+        self.command_errors = registry.counter("command_errors_total", "Commands that failed", ("command", "exception"))
+        self.commands_in_flight = registry.gauge("commands_in_flight", "Commands currently running")
+        self.listener_duration = registry.histogram("listener_duration_seconds", "Time taken by a listener", ("listener", "event"))
+        self.listener_errors = registry.counter("listener_errors_total", "Listeners that raised", ("listener", "event", "exception"))
+        self.listeners_in_flight = registry.gauge("listeners_in_flight", "Listeners currently running", ("event",))
+
+    def record_command_error(self, command: str, exception: BaseException) -> None:
+        # Lightbulb wraps anything raised by a command, the original is the interesting part
+        original = getattr(exception, "original", None) or exception
+        self.command_errors.inc(command=command, exception=type(original).__name__)
+
+    def wrap_listener(self, event_type: type, callback: Callable[[Any], Awaitable[None]]) -> Callable[[Any], Awaitable[None]]:
+        """ Wraps a listener so that each call is timed and counted """
+        listener = getattr(callback, "__qualname__", repr(callback))
+        event_name = event_type.__name__
+
+        @functools.wraps(callback)
+        async def instrumented(event: Any) -> None:
+            self.listeners_in_flight.inc(event=event_name)
+            started = time.perf_counter()
+            try:
+                await callback(event)
+            except Exception as exc:
+                self.listener_errors.inc(listener=listener, event=event_name, exception=type(exc).__name__)
+                raise
+            finally:
+                self.listeners_in_flight.dec(event=event_name)
+                self.listener_duration.observe(time.perf_counter() - started, listener=listener, event=event_name)
+
+        return instrumented
@@ -0,0 +1,110 @@
+import asyncio
+import enum
+import logging
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class RESTPriority(enum.IntEnum):
+    """ How important a REST call is, lower values go first """
+    HIGH = 0
+    """ Calls that enforce something, i.e. moving a punished member, these never wait """
+    NORMAL = 1
+    """ Responses people are waiting on, these wait for budget but are never dropped """
+    LOW = 2
+    """ Jokes and cosmetic changes, these only use spare budget and are dropped if they wait too long """
+
+
+class RESTScheduler:
+    """ Prioritises the REST calls made by plugins so that low priority calls don't delay important ones
+
+        hikari already waits on Discord's rate limits, but it serves calls in the order they are made.
+        This keeps a local token bucket of the request budget, calls below HIGH priority wait for budget,
+        and LOW priority calls may only use the part of the bucket above low_reserve.
+
+        Calls can be given a key, if a newer call with the same key is made while one is still waiting
+        then the older one is dropped, i.e. only the last of several nickname edits to a member is sent.
+
+        Attributes:
+            rate (float): The number of calls per second the budget refills by
+            burst (int): The maximum budget that can build up
+            low_reserve (float): Budget kept back from LOW priority calls
+            low_max_delay (float): Time in seconds a LOW priority call may wait before it is dropped
+    """
+
+    def __init__(self, rate: float, burst: int, low_reserve: float, low_max_delay: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.low_reserve = low_reserve
+        self.low_max_delay = low_max_delay
+
+        self.submitted: Counter[RESTPriority] = Counter()
+        self.deferred: Counter[RESTPriority] = Counter()
+        self.shed: Counter[RESTPriority] = Counter()
+        self.coalesced: Counter[RESTPriority] = Counter()
+
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._generations: Dict[Hashable, int] = {}
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _required(self, priority: RESTPriority) -> float:
+        return 1 + self.low_reserve if priority == RESTPriority.LOW else 1
+
+    async def run(self, priority: RESTPriority, call: Callable[[], Awaitable[T]], key: Optional[Hashable] = None) -> Optional[T]:
+        """ Waits for budget then awaits call(), returns None if the call was dropped """
+        self.submitted[priority] += 1
+
+        if key is not None:
+            generation = self._generations[key] = self._generations.get(key, 0) + 1
+
+        self._refill()
+        if priority != RESTPriority.HIGH and self._tokens < self._required(priority):
+            self.deferred[priority] += 1
+            started = time.monotonic()
+
+            while self._tokens < self._required(priority):
+                if priority == RESTPriority.LOW and time.monotonic() - started >= self.low_max_delay:
+                    self.shed[priority] += 1
+                    logger.debug('Dropped low priority REST call after waiting %.1fs', time.monotonic() - started)
+                    self._forget(key, generation if key is not None else None)
+                    return None
+
+                await asyncio.sleep((self._required(priority) - self._tokens) / self.rate)
+                self._refill()
+
+        if key is not None:
+            current = self._generations.get(key)
+            self._forget(key, generation)
+            if current != generation:
+                # A newer call with the same key replaces this one
+                self.coalesced[priority] += 1
+                return None
+
+        # HIGH priority calls can take the budget negative, so the others hold back until it recovers
+        self._tokens -= 1
+        return await call()
+
+    def _forget(self, key: Optional[Hashable], generation: Optional[int]) -> None:
+        if key is not None and self._generations.get(key) == generation:
+            del self._generations[key]
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            priority.name.lower(): {
+                "submitted": self.submitted[priority],
+                "deferred": self.deferred[priority],
+                "shed": self.shed[priority],
+                "coalesced": self.coalesced[priority],
+            }
+            for priority in RESTPriority
+        }
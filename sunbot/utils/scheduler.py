@@ -0,0 +1,101 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Generic, Hashable, List, Optional, Set, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K", bound=Hashable)
+
+
+class DeadlineScheduler(Generic[K]):
+    """ Calls a callback for each key once its deadline passes
+
+        Deadlines are kept in a min-heap and a single task sleeps until the earliest one,
+        so there is no periodic scanning no matter how many keys are scheduled.
+
+        Attributes:
+            callback (Callable[[K], Awaitable[None]]): Called with the key once its deadline has passed
+    """
+
+    def __init__(self, callback: Callable[[K], Awaitable[None]]) -> None:
+        self.callback = callback
+
+        self._heap: List[Tuple[float, int, K]] = []
+        self._deadlines: Dict[K, float] = {}
+        self._counter = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Callbacks run in their own tasks so a slow one doesn't hold up later deadlines, kept so they aren't garbage collected
+        self._firing: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._deadlines
+
+    def schedule(self, key: K, deadline: float) -> None:
+        """ Schedules (or reschedules) a key to fire at the given unix timestamp """
+        self._deadlines[key] = deadline
+        self._counter += 1
+        heapq.heappush(self._heap, (deadline, self._counter, key))
+
+        # Only wake the timer if this is now the earliest deadline
+        if self._heap[0][2] == key:
+            self._wakeup.set()
+
+    def cancel(self, key: K) -> None:
+        """ Stops a key from firing, its heap entry is discarded lazily """
+        self._deadlines.pop(key, None)
+
+        # Rebuild the heap if it is mostly cancelled entries
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._deadlines):
+            self._heap = [entry for entry in self._heap if self._deadlines.get(entry[2]) == entry[0]]
+            heapq.heapify(self._heap)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in self._firing:
+            task.cancel()
+
+    def _discard_stale(self) -> None:
+        while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    async def _run(self) -> None:
+        while True:
+            self._discard_stale()
+            self._wakeup.clear()
+
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+
+            task = asyncio.create_task(self._fire(key))
+            self._firing.add(task)
+            task.add_done_callback(self._firing.discard)
+
+    async def _fire(self, key: K) -> None:
+        try:
+            await self.callback(key)
+        except Exception:
+            logger.exception('Scheduled callback failed for %s', key)
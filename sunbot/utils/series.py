@@ -0,0 +1,53 @@
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+
+class TimeSeries:
+    """ A bounded series of timestamped samples, the oldest samples are dropped once it is full
+        Attributes:
+            maxlen (int): The maximum number of samples kept
+            total (int): The number of samples ever recorded, including those that have been dropped
+    """
+
+    def __init__(self, maxlen: int) -> None:
+        self.maxlen = maxlen
+        self.total = 0
+        self._samples: Deque[Tuple[float, float]] = deque(maxlen=maxlen)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, value: float, at: Optional[float] = None) -> None:
+        self._samples.append((time.time() if at is None else at, value))
+        self.total += 1
+
+    @property
+    def latest(self) -> Optional[float]:
+        return self._samples[-1][1] if self._samples else None
+
+    def samples(self, since: Optional[float] = None) -> List[Tuple[float, float]]:
+        """ The (timestamp, value) samples kept, optionally only those recorded after since """
+        if since is None:
+            return list(self._samples)
+        return [sample for sample in self._samples if sample[0] >= since]
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """ The value below which percent of the kept samples fall, using the nearest sample """
+        if not self._samples:
+            return None
+        values = sorted(value for _, value in self._samples)
+        return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+    def summary(self) -> Dict[str, float]:
+        if not self._samples:
+            return {"count": 0}
+
+        values = [value for _, value in self._samples]
+        return {
+            "count": len(values),
+            "latest": values[-1],
+            "mean": sum(values) / len(values),
+            "max": max(values),
+            "p95": self.percentile(95),
+        }
@@ -0,0 +1,49 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Dict, Iterator, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class StartupTimer:
+    """ Times each phase of startup so slow starts can be traced to a cause
+
+        Phases may overlap when they run concurrently, so they don't add up to the total.
+
+        Attributes:
+            started (float): When the timer was created, from time.perf_counter
+            phases (Dict[str, float]): Time in seconds each phase took, in the order they finished
+    """
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self._running: Dict[str, float] = {}
+
+    def start(self, name: str) -> None:
+        self._running[name] = time.perf_counter()
+
+    def finish(self, name: str) -> None:
+        started = self._running.pop(name, None)
+        if started is not None:
+            self.phases[name] = time.perf_counter() - started
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.finish(name)
+
+    async def run(self, name: str, awaitable: Awaitable[T]) -> T:
+        with self.phase(name):
+            return await awaitable
+
+    def report(self) -> None:
+        total = time.perf_counter() - self.started
+        phases = ", ".join(f"{name} {elapsed:.2f}s" for name, elapsed in self.phases.items())
+        logger.info('Started in %.2fs (%s)', total, phases)
@@ -0,0 +1,163 @@
+import functools
+import random
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from sunbot.config import SentryConfig
+
+if TYPE_CHECKING:
+    from sentry_sdk.tracing import Span, Transaction
+
+# Only imported once Sentry is set up, it is slow to import and isn't needed otherwise
+sentry_sdk = None
+
+# Events that arrive often enough that tracing each one would cost more than it tells us
+CHATTY_EVENTS = frozenset({
+    "GuildMessageCreateEvent",
+    "MessageCreateEvent",
+    "GuildMessageUpdateEvent",
+    "MessageUpdateEvent",
+    "GuildMessageDeleteEvent",
+    "MessageDeleteEvent",
+    "VoiceStateUpdateEvent",
+    "PresenceUpdateEvent",
+    "GuildTypingEvent",
+    "TypingIndicatorEvent",
+    "MemberUpdateEvent",
+    # Commands are traced on their own, the interaction that carried them adds nothing
+    "InteractionCreateEvent",
+})
+
+
+def plugin_name(module: str) -> str:
+    """ The plugin a module belongs to, i.e. sunbot.plugins.fun.ai is fun.ai """
+    return module.split("sunbot.plugins.", 1)[-1]
+
+
+class TracePolicy:
+    """ Decides which transactions are sent to Sentry, and caps how many events are sent each minute
+
+        Listeners are sampled when they start, chatty ones rarely. Commands are always traced and
+        decided when they finish, so a slow or failed command is always kept.
+
+        Attributes:
+            config (SentryConfig): The sample rates and limits to use
+            dropped (int): Events dropped because the per-minute cap was reached
+    """
+
+    def __init__(self, config: SentryConfig) -> None:
+        self.config = config
+        self.dropped = 0
+
+        # event type -> (start of the current minute, events sent in it)
+        self._windows: Dict[str, List[float]] = {}
+
+    def traces_sampler(self, sampling_context: Dict[str, Any]) -> float:
+        op = sampling_context.get("transaction_context", {}).get("op")
+        if op == "command":
+            return 1.0
+        if op == "listener":
+            if sampling_context.get("event") in CHATTY_EVENTS:
+                return self.config.chatty_listener_sample_rate
+            return self.config.listener_sample_rate
+        return self.config.traces_sample_rate
+
+    def finish_command(self, transaction: "Transaction", command: str, duration: float, failed: bool) -> None:
+        """ Decides whether to keep a command's transaction, called just before it finishes """
+        transaction.name = command
+        if command in self.config.health_commands:
+            keep = False
+        elif failed or transaction.status not in (None, "ok") or duration >= self.config.slow_command_threshold:
+            keep = True
+        else:
+            keep = random.random() < self.config.traces_sample_rate
+        transaction.sampled = keep
+
+    def _allow(self, kind: str) -> bool:
+        now = time.monotonic()
+        window = self._windows.get(kind)
+        if window is None or now - window[0] >= 60:
+            window = self._windows[kind] = [now, 0]
+
+        if window[1] >= self.config.max_events_per_minute:
+            self.dropped += 1
+            return False
+        window[1] += 1
+        return True
+
+    def before_send(self, event: Dict[str, Any], hint: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return event if self._allow("error") else None
+
+    def before_send_transaction(self, event: Dict[str, Any], hint: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return event if self._allow("transaction") else None
+
+
+def init_sentry(config: SentryConfig) -> TracePolicy:
+    """ Imports and sets up Sentry, returning the policy used to sample it """
+    global sentry_sdk
+    import sentry_sdk as sdk
+
+    policy = TracePolicy(config)
+    sdk.init(
+        dsn=config.dsn,
+        sample_rate=config.sample_rate,
+        traces_sampler=policy.traces_sampler,
+        before_send=policy.before_send,
+        before_send_transaction=policy.before_send_transaction,
+    )
+    sentry_sdk = sdk
+    return policy
+
+
+def fail_current_transaction() -> None:
+    """ Marks the current transaction as failed, so that it is kept """
+    if sentry_sdk is not None and (transaction := sentry_sdk.Hub.current.scope.transaction) is not None:
+        transaction.set_status("internal_error")
+
+
+@contextmanager
+def trace(op: str, name: str, plugin: str, new_transaction: bool = False, **sampling_context: Any) -> Iterator[Optional["Span"]]:
+    """ Traces a block as a span of the current transaction, or as a new transaction if there isn't one
+
+        Does nothing if Sentry isn't set up.
+    """
+    if sentry_sdk is None or sentry_sdk.Hub.current.client is None:
+        yield None
+        return
+
+    hub = sentry_sdk.Hub.current
+
+    parent = hub.scope.span
+    if parent is None or new_transaction:
+        # Listeners run concurrently, each gets its own hub so they don't share a scope
+        with sentry_sdk.Hub(hub) as task_hub:
+            with task_hub.start_transaction(op=op, name=name, custom_sampling_context=sampling_context) as transaction:
+                transaction.set_tag("plugin", plugin)
+                yield transaction
+        return
+
+    # Started and finished by hand, entering the span would make it the current span for everything sharing the scope
+    span = parent.start_child(op=op, description=name)
+    span.set_tag("plugin", plugin)
+    try:
+        yield span
+    except BaseException:
+        span.set_status("internal_error")
+        raise
+    finally:
+        span.finish()
+
+
+def trace_listener(event_type: type, callback: Callable[[Any], Awaitable[None]]) -> Callable[[Any], Awaitable[None]]:
+    """ Wraps a listener so that it is traced """
+    listener = getattr(callback, "__qualname__", repr(callback))
+    plugin = plugin_name(getattr(callback, "__module__", None) or "")
+    event_name = event_type.__name__
+
+    @functools.wraps(callback)
+    async def traced(event: Any) -> None:
+        with trace("listener", f"{event_name}:{listener}", plugin, event=event_name):
+            await callback(event)
+
+    return traced